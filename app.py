@@ -1,20 +1,18 @@
 # app.py
 
 
-# Ensure the latest mapping.yaml changes are picked up
-import importlib, mcc as _mcc_mod
-importlib.reload(_mcc_mod)
-from mcc import FORMATS     # refresh the constant after reload
-
 import io, textwrap
 import streamlit as st
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
 from pathlib import Path
 import base64
-from mcc import call_fracto_parallel, write_excel_from_ocr, stamp_job_number
-from PyPDF2 import PdfReader
+import hashlib
+# pandas and matplotlib are imported inside the review section and cached
+# helpers below – the upload screen never needs them and together they cost
+# over a second.
+from mcc import (call_fracto_parallel, write_excel_from_ocr, PdfDocument, format_registry,
+                 diff_frames, patch_excel, job_manager, export_ocr, export_kind,
+                 EXPORT_FORMATS, OcrTable)
 
 # ── Page config (must be first Streamlit command) ─────────────
 st.set_page_config(
@@ -190,20 +188,62 @@ def build_logo_strip(logo_paths: list[str]) -> str:
     """
     Return HTML for the scrolling logo strip.
     Each file is read from disk and embedded as a Base64 data‑URI,
-    so it renders correctly on Streamlit Cloud.
+    so it renders correctly on Streamlit Cloud.  The HTML is cached per
+    (path, mtime, size) set, so reruns only stat the files.
     """
-    tags = ""
     script_dir = Path(__file__).parent
+    stamps = []
     for rel_path in logo_paths:
         img_path = (script_dir / rel_path).expanduser().resolve()
-        if not img_path.exists():
+        try:
+            st_ = img_path.stat()
+        except OSError:
             continue
+        stamps.append((str(img_path), st_.st_mtime_ns, st_.st_size))
+    return _logo_strip_html(tuple(stamps))
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _logo_strip_html(stamps: tuple[tuple[str, int, int], ...]) -> str:
+    tags = ""
+    for path, _, _ in stamps:
+        img_path = Path(path)
         mime = "image/svg+xml" if img_path.suffix.lower() == ".svg" else "image/png"
         b64   = base64.b64encode(img_path.read_bytes()).decode("utf-8")
         tags += f"<img src='data:{mime};base64,{b64}' alt='' />"
     # Duplicate sequence so the CSS animation loops seamlessly
     return f"<div class='logo-strip-wrapper'><div class='logo-strip'>{tags}{tags}</div></div>"
 
+
+# ── Per-rerun caches ─────────────────────────────────────────
+# Streamlit re-executes this script on every widget change. Anything
+# derived from uploaded/generated bytes is keyed by their SHA‑256 (the bytes
+# themselves are passed as `_`‑prefixed, i.e. unhashed, arguments) so it is
+# computed once per distinct content and shared across sessions.
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def pdf_page_count(digest: str, _data: bytes) -> int:
+    return PdfDocument(_data).page_count
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def top_sku_chart(labels: tuple, values: tuple) -> bytes:
+    """PNG of the Top‑SKU bar chart; keyed by the plotted data itself."""
+    from matplotlib.figure import Figure
+    import pandas as pd
+    fig = Figure()
+    ax = fig.subplots()
+    pd.Series(values, index=pd.Index(labels, name="Part No.")).plot(kind="barh", ax=ax)
+    ax.invert_yaxis()
+    ax.set_xlabel("Qty")
+    ax.set_ylabel("Part No.")
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight")
+    return buf.getvalue()
+
 st.markdown(
     """
     <style>
@@ -255,9 +295,19 @@ if "excel_bytes" not in st.session_state:
     st.session_state["excel_bytes"] = None
 if "excel_filename" not in st.session_state:
     st.session_state["excel_filename"] = ""
+if "ocr_df" not in st.session_state:
+    st.session_state["ocr_df"] = None
+if "export_bytes" not in st.session_state:
+    st.session_state["export_bytes"] = None    # CSV / JSON Lines / Parquet output
+    st.session_state["export_kind"] = "xlsx"
+    st.session_state["export_filename"] = ""
 if "edited_excel_bytes" not in st.session_state:
     st.session_state["edited_excel_bytes"] = None
     st.session_state["edited_filename"] = ""
+if "job_id" not in st.session_state:
+    st.session_state["job_id"] = None     # background job of this session
+    st.session_state["job_error"] = None
+    st.session_state["job_metrics"] = None
 
 # ── Simple username/password gate ─────────────────────────────
 if "authenticated" not in st.session_state:
@@ -305,15 +355,16 @@ pdf_file = st.file_uploader("Upload PDF", type=["pdf"])
 
 # Show thumbnail info after upload
 if pdf_file:
-    # Show file thumbnail info
+    # Page count is cached per file content; Process parses the PDF once more
+    # for stamping and splitting (a parsed document is mutable, so it is not
+    # shared between reruns or sessions).
     file_size_kb = pdf_file.size / 1024
     try:
-        page_count = len(PdfReader(pdf_file).pages)
+        pdf_bytes  = pdf_file.getvalue()
+        page_count = pdf_page_count(content_hash(pdf_bytes), pdf_bytes)
     except Exception:
         page_count = "?"
     st.info(f"**{pdf_file.name}**  •  {file_size_kb:,.1f} KB  •  {page_count} page(s)")
-    # Reset file pointer for later reading
-    pdf_file.seek(0)
 
 # ── Manual overrides ─────────────────────────────────────────────
 st.markdown("#### Optional manual fields")
@@ -333,61 +384,139 @@ for col in manual_fields:
     else:
         manual_inputs[col] = val  # Excel overrides
 
-# Formats come straight from mapping.yaml ("Format 1", "Format 2", …)
-format_names = list(FORMATS.keys())
+# Formats come straight from mapping.yaml ("Format 1", "Format 2", …);
+# the registry re-reads the file whenever it changes on disk.
+format_names = format_registry.names()
 selected_format_key = st.selectbox("Select Excel output format", format_names)
-selected_format_cfg = FORMATS[selected_format_key]
+selected_format = format_registry.get(selected_format_key)
+output_kind = st.selectbox(
+    "Output file",
+    list(EXPORT_FORMATS),
+    format_func=lambda kind: EXPORT_FORMATS[kind][0],
+    help="CSV, JSON Lines and Parquet skip workbook generation – much faster "
+         "for large extractions. The format's column mapping applies to all of them.",
+)
+
+# ── Background processing ───────────────────────────────────
+# Jobs run on mcc's shared worker pool, so a long OCR run neither blocks
+# this session's reruns nor other operators; the session only keeps the id.
+def process_pdf_job(job, pdf_bytes: bytes, file_name: str, job_no: str | None,
+                    format_name: str, overrides: dict[str, str],
+                    output_kind: str = "xlsx") -> dict:
+    """Stamp → OCR → Excel (or another export kind) for one upload; runs off the script thread."""
+    fmt = format_registry.get(format_name)
+    job.update(0.02, "Reading PDF")
+    doc = PdfDocument(pdf_bytes)
+    if job_no:
+        doc.stamp_job_number(job_no)
+
+    results = call_fracto_parallel(doc, file_name, on_chunk=job.chunk_reporter(0.05, 0.9))
+
+    # One columnar table feeds both the output file and the preview grid
+    label, suffixes, _ = EXPORT_FORMATS[output_kind]
+    job.update(0.92, f"Writing {label}")
+    table = fmt.table(results, overrides=overrides)
+    buffer = io.BytesIO()
+    if output_kind != "xlsx":
+        export_ocr(table, buffer, kind=output_kind)
+        return {
+            "excel_bytes":     None,
+            "export_bytes":    buffer.getvalue(),
+            "export_kind":     output_kind,
+            "export_filename": f"{Path(file_name).stem}_ocr{suffixes[0]}",
+            "ocr_df":          table.to_dataframe(),
+        }
+    write_excel_from_ocr(
+        table,
+        buffer,
+        template_path=fmt.template_path,
+        sheet_name=fmt.sheet_name,
+    )
+    return {
+        "excel_bytes":    buffer.getvalue(),
+        "export_bytes":   None,
+        "export_kind":    "xlsx",
+        "ocr_df":         table.to_dataframe(),
+        "excel_sheet":    fmt.sheet_name,
+        "excel_filename": f"{Path(file_name).stem}_ocr.xlsx",
+    }
+
+
+@st.fragment(run_every=1.0)
+def show_job_progress(job_id: str) -> None:
+    """Poll the session's job; on completion hand its output to the page."""
+    job = job_manager.get(job_id)
+    if job is None:
+        st.session_state["job_id"] = None
+        st.warning("The processing job is no longer available – please run it again.")
+        return
+    if job.active:
+        text = job.message
+        if job.state == "queued":
+            ahead = job_manager.queued_ahead(job_id)
+            text = f"Queued – {ahead} document(s) ahead" if ahead else "Queued"
+        st.progress(job.progress, text=f"{job.name}: {text}")
+        return
+
+    st.session_state["job_id"] = None
+    if job.state == "error":
+        st.toast(f"❌ Error: {job.error}", icon="⚠️")
+        st.session_state["job_error"] = job.error
+    else:
+        st.session_state.update(job.result)
+        st.session_state["job_metrics"] = job.metrics.summary()
+        st.session_state["edited_excel_bytes"] = None
+        st.toast(f"✅ {EXPORT_FORMATS[st.session_state['export_kind']][0]} generated!", icon="🎉")
+    st.rerun()
+
+
+active_job = job_manager.get(st.session_state.get("job_id"))
 
 # Process button
-run = st.button("⚙️ Process PDF", disabled=pdf_file is None)
+run = st.button(
+    "⚙️ Process PDF",
+    disabled=pdf_file is None or (active_job is not None and active_job.active),
+)
 
 if run:
     if not pdf_file:
         st.warning("Please upload a PDF first.")
         st.stop()
+    st.session_state["job_error"] = None
+    st.session_state["job_id"] = job_manager.submit(
+        process_pdf_job,
+        pdf_file.getvalue(),
+        pdf_file.name,
+        job_no,
+        selected_format.name,
+        dict(manual_inputs),
+        output_kind,
+        name=pdf_file.name,
+    )
+    st.rerun()                 # re-render with the button disabled
 
-    progress = st.progress(0.0, text="Uploading & extracting …")
-    try:
-        pdf_bytes = pdf_file.read()
-        progress.progress(0.2)
-        if job_no:
-            pdf_bytes = stamp_job_number(pdf_bytes, job_no)
-        progress.progress(0.4)
-
-        results = call_fracto_parallel(pdf_bytes, pdf_file.name)
-        progress.progress(0.8)
-
-        buffer = io.BytesIO()
-        write_excel_from_ocr(
-            results,
-            buffer,
-            overrides=manual_inputs,
-            mappings=selected_format_cfg["mappings"],
-            template_path=selected_format_cfg.get("template_path"),
-            sheet_name=selected_format_cfg.get("sheet_name"),
-        )
-        progress.progress(1.0, text="Done!")
-        st.session_state["excel_bytes"]   = buffer.getvalue()
-        base_name = Path(pdf_file.name).stem
-        st.session_state["excel_filename"] = f"{base_name}_ocr.xlsx"
-        st.toast("✅ Excel generated!", icon="🎉")
-    except Exception as exc:
-        st.toast(f"❌ Error: {exc}", icon="⚠️")
-        st.error(f"Processing failed: {exc}")
-        st.stop()
+if st.session_state.get("job_id"):
+    show_job_progress(st.session_state["job_id"])
+elif st.session_state.get("job_error"):
+    st.error(f"Processing failed: {st.session_state['job_error']}")
 
 # ── Preview & download ────────────────────────────────────────
-if st.session_state["excel_bytes"]:
+if st.session_state["excel_bytes"] or st.session_state["export_bytes"]:
+    import pandas as pd
+
+    result_kind = st.session_state["export_kind"] if st.session_state["export_bytes"] else "xlsx"
+    result_label, _, result_mime = EXPORT_FORMATS[result_kind]
     st.markdown("### 2. Review and export")
     st.download_button(
-        "⬇️ Download original Excel",
-        data=st.session_state["excel_bytes"],
-        file_name=st.session_state["excel_filename"],
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        f"⬇️ Download original {result_label}",
+        data=st.session_state["excel_bytes"] or st.session_state["export_bytes"],
+        file_name=(st.session_state["excel_filename"] if result_kind == "xlsx"
+                   else st.session_state["export_filename"]),
+        mime=result_mime,
         key="download_original",
     )
 
-    df = pd.read_excel(io.BytesIO(st.session_state["excel_bytes"]))
+    df = st.session_state["ocr_df"]       # set together with the output bytes
     edited_df = st.data_editor(
         df,
         num_rows="dynamic",
@@ -396,33 +525,47 @@ if st.session_state["excel_bytes"]:
     )
 
     if st.button("💾 Save edits"):
-        # Load original workbook to preserve formatting
-        from openpyxl import load_workbook
-        wb_orig = load_workbook(io.BytesIO(st.session_state["excel_bytes"]))
-        ws      = wb_orig.active
-
-        # Overwrite data rows (assumes header is row 1)
-        for r_idx, (_, row) in enumerate(edited_df.iterrows(), start=2):
-            for c_idx, value in enumerate(row, start=1):
-                ws.cell(row=r_idx, column=c_idx, value=value)
-
-        out_buf = io.BytesIO()
-        wb_orig.save(out_buf)
-        st.session_state["edited_excel_bytes"] = out_buf.getvalue()
-        st.session_state["edited_filename"] = (
-            Path(st.session_state["excel_filename"]).with_suffix("").name + "_edited.xlsx"
+        diff = diff_frames(df, edited_df)
+        if result_kind == "xlsx":
+            # Patch only the changed / added / deleted rows into the original
+            # workbook (header in row 1); its formatting is left untouched.
+            st.session_state["edited_excel_bytes"] = patch_excel(
+                st.session_state["excel_bytes"],
+                diff,
+                sheet_name=st.session_state.get("excel_sheet"),
+            )
+            original = st.session_state["excel_filename"]
+        else:
+            # Flat files have no formatting to keep – just write the grid again
+            buffer = io.BytesIO()
+            export_ocr(OcrTable.from_dataframe(edited_df), buffer, kind=result_kind)
+            st.session_state["edited_excel_bytes"] = buffer.getvalue()
+            original = st.session_state["export_filename"]
+        suffix = Path(original).suffix
+        st.session_state["edited_filename"] = Path(original).with_suffix("").name + f"_edited{suffix}"
+        st.success(
+            f"Edits saved ({len(diff['changed'])} cell(s) changed, "
+            f"{len(diff['added'])} row(s) added, {len(diff['deleted'])} removed) "
+            f"— scroll below to download the {suffix} file."
         )
-        st.success("Edits saved — scroll below to download the .xlsx file.")
 
     if st.session_state.get("edited_excel_bytes"):
+        edited_kind = export_kind(st.session_state["edited_filename"]) or "xlsx"
         st.download_button(
-            "⬇️ Download edited Excel",
+            f"⬇️ Download edited {EXPORT_FORMATS[edited_kind][0]}",
             data=st.session_state["edited_excel_bytes"],
             file_name=st.session_state["edited_filename"],
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            mime=EXPORT_FORMATS[edited_kind][2],
             key="download_edited",
         )
 
+    if st.session_state.get("job_metrics"):
+        with st.expander("⏱️ Pipeline metrics (last run)"):
+            run_metrics = st.session_state["job_metrics"]
+            stages = run_metrics["histograms"].get("stage_seconds", {})
+            st.table(pd.DataFrame.from_dict(stages, orient="index"))
+            st.json(run_metrics, expanded=False)
+
     # ── Quick stats & visualisations ───────────────────────────
     view_df = edited_df if st.session_state.get("edited_excel_bytes") else df
 
@@ -457,12 +600,8 @@ if st.session_state["excel_bytes"]:
         if top_qty.empty or top_qty.shape[0] < 1:
             st.info("No Qty data available to plot.")
         else:
-            fig, ax = plt.subplots()
-            top_qty.plot(kind="barh", ax=ax)
-            ax.invert_yaxis()
-            ax.set_xlabel("Qty")
-            ax.set_ylabel("Part No.")
-            st.pyplot(fig)
+            png = top_sku_chart(tuple(top_qty.index), tuple(top_qty.to_list()))
+            st.image(png, width="stretch")
 
 st.markdown("---")
 
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+bench_mcc.py
+────────────
+Reproducible end-to-end benchmark of the mcc pipeline against a local
+stand-in for Fracto's ``upload-file-smart-ocr`` endpoint.
+
+Synthetic invoice PDFs are generated with reportlab (seeded), served through
+an in-process stub with configurable latency, jitter and error rate, and the
+pipeline is timed stage by stage:
+
+    parse   – PdfDocument(...) on the raw upload
+    split   – serializing every chunk (unstamped)
+    stamp   – the same with a job number stamped in
+    e2e     – call_fracto_parallel end to end, per chunk size × MAX_PARALLEL
+    excel   – write_excel_from_ocr (streaming and regular workbook)
+
+Every run is written to ``<out>/bench-<timestamp>-<git sha>.json``;
+``--compare`` diffs against an earlier file and exits 1 when any median got
+slower than ``--tolerance``.
+
+Usage:
+    python bench_mcc.py [--pages 10,50,200] [--chunk-sizes 2,4,8] [--parallel 4,10]
+                        [--strategies fixed,adaptive] [--latency 0.2] [--per-page 0.02]
+                        [--jitter 0.05] [--error-rate 0] [--rows-per-page 5]
+                        [--lines 40] [--repeat 3] [--seed 0]
+                        [--out bench_results] [--compare BASELINE.json] [--tolerance 0.15]
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# The pipeline reads these at import; the stub address is patched in later.
+os.environ["FRACTO_CACHE"] = "0"
+os.environ.setdefault("FRACTO_API_KEY", "bench")
+
+import mcc  # noqa: E402
+
+
+# ─── Synthetic PDFs ──────────────────────────────────────────────────────
+def make_pdf(pages: int, lines: int = 40, invoice_every: int = 3, seed: int = 0) -> bytes:
+    """
+    An invoice-like PDF of *pages* pages with *lines* text lines each; every
+    *invoice_every*-th page starts a new "Invoice No." block. Same arguments,
+    same bytes (reportlab's invariant mode pins the timestamps and IDs).
+    """
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    rng = random.Random(seed)
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4, invariant=1)
+    _, height = A4
+    for p in range(pages):
+        y = height - 60
+        if p % invoice_every == 0:
+            c.setFont("Helvetica-Bold", 14)
+            c.drawString(50, y, f"Invoice No. INV-{seed:03d}-{p // invoice_every:05d}")
+            y -= 30
+        c.setFont("Helvetica", 8)
+        for i in range(lines):
+            c.drawString(50, y, f"{i + 1:>3}  PN-{rng.randrange(10**6):06d}  "
+                                f"{rng.choice(('Bolt', 'Nut', 'Washer', 'Gasket', 'Valve'))} "
+                                f"{rng.randrange(1, 500):>4} pcs  {rng.uniform(1, 999):9.2f} USD")
+            y -= 12
+            if y < 40:
+                break
+        c.showPage()
+    c.save()
+    return buf.getvalue()
+
+
+# ─── Fracto stand-in ─────────────────────────────────────────────────────
+_PAGE_RE = re.compile(rb"/Type\s*/Page\b")
+
+
+class FractoStub:
+    """
+    Local HTTP server answering like ``upload-file-smart-ocr``.
+
+    Each request sleeps ``latency + per_page·pages ± jitter`` seconds (pages
+    are counted in the uploaded PDF), fails with HTTP 503 at *error_rate*
+    and otherwise returns *rows_per_page* rows per page shaped like the
+    default mapping.yaml format. Use as a context manager; ``url`` is the
+    endpoint and ``requests`` / ``failures`` are counted.
+    """
+
+    def __init__(self, latency: float = 0.2, per_page: float = 0.02, jitter: float = 0.05,
+                 error_rate: float = 0.0, rows_per_page: int = 5, seed: int = 0):
+        self.latency       = latency
+        self.per_page      = per_page
+        self.jitter        = jitter
+        self.error_rate    = error_rate
+        self.rows_per_page = rows_per_page
+        self.requests      = 0
+        self.failures      = 0
+        self._rng          = random.Random(seed)
+        self._lock         = threading.Lock()
+        self._fields       = list(mcc.format_registry.get().fields.values()) or ["Serial_Number"]
+        self._server: ThreadingHTTPServer | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/upload-file-smart-ocr"
+
+    def _row(self, serial: int) -> dict:
+        row = {f: f"{f[:3].upper()}-{serial}" for f in self._fields}
+        row.update(Serial_Number=serial, Qty=serial % 50 + 1, Unit_Price=round(serial * 1.5, 2))
+        return row
+
+    def _plan(self, body: bytes) -> tuple[float, bool, int]:
+        pages = max(len(_PAGE_RE.findall(body)), 1)
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self.per_page * pages + self._rng.uniform(-self.jitter, self.jitter)
+            fail  = self._rng.random() < self.error_rate
+            if fail:
+                self.failures += 1
+        return max(delay, 0.0), fail, pages
+
+    def __enter__(self) -> "FractoStub":
+        stub = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"          # keep-alive, like the real API
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                delay, fail, pages = stub._plan(body)
+                time.sleep(delay)
+                if fail:
+                    out, status = b"", 503
+                else:
+                    rows = [stub._row(i + 1) for i in range(pages * stub.rows_per_page)]
+                    out, status = json.dumps({"data": rows}).encode(), 200
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, *args):
+                pass
+
+        ThreadingHTTPServer.request_queue_size = 256
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fracto-stub",
+                         daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# ─── Measurements ────────────────────────────────────────────────────────
+def _timed(fn, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {"median_s": round(statistics.median(times), 5), "min_s": round(min(times), 5)}
+
+
+def bench_split(pdf: bytes, pages: int, chunk_sizes: list[int], repeat: int) -> list[dict]:
+    out = [{"bench": "parse", "pages": pages, **_timed(lambda: mcc.PdfDocument(pdf), repeat)}]
+    for size in chunk_sizes:
+        def _split(job_no=None):
+            doc = mcc.PdfDocument(pdf)
+            if job_no:
+                doc.stamp_job_number(job_no)
+            return doc.split(size)
+        out.append({"bench": "split", "pages": pages, "chunk_size": size,
+                    **_timed(_split, repeat)})
+        out.append({"bench": "stamp", "pages": pages, "chunk_size": size,
+                    **_timed(lambda: _split("JOB-BENCH-0001"), repeat)})
+    return out
+
+
+def bench_e2e(pdf: bytes, pages: int, stub: FractoStub, chunk_sizes: list[int],
+              parallel: list[int], strategies: list[str], repeat: int) -> tuple[list[dict], list]:
+    out, results = [], []
+    for strategy in strategies:
+        for size in chunk_sizes:
+            for par in parallel:
+                mcc.CHUNK_STRATEGY, mcc.CHUNK_SIZE_PAGES, mcc.MAX_PARALLEL = strategy, size, par
+                times, errors, before = [], 0, stub.requests
+                with mcc.collect_metrics() as run:
+                    for _ in range(repeat):
+                        t0 = time.perf_counter()
+                        results = mcc.call_fracto_parallel(pdf, f"bench-{pages}p.pdf")
+                        times.append(time.perf_counter() - t0)
+                        errors += sum(r.get("status") != "ok" for r in results)
+                summary = run.summary()
+                upload  = summary["histograms"].get("stage_seconds", {}).get("upload", {})
+                median  = statistics.median(times)
+                out.append({
+                    "bench": "e2e", "pages": pages, "chunk_size": size, "parallel": par,
+                    "strategy": strategy,
+                    "median_s": round(median, 5), "min_s": round(min(times), 5),
+                    "pages_per_s": round(pages / median, 2),
+                    "chunks": len(results),
+                    "requests": (stub.requests - before) // repeat,
+                    "retries": sum((summary["counters"].get("retries_total") or {}).values()) // repeat,
+                    "failed_chunks": errors // repeat,
+                    "upload_p50_s": upload.get("p50_s"), "upload_p95_s": upload.get("p95_s"),
+                })
+                print(f"  e2e   {pages:>5}p  {strategy:<8} chunk={size:<3} par={par:<3} "
+                      f"{median:7.3f}s  {pages / median:8.1f} pages/s", flush=True)
+    return out, results
+
+
+def bench_excel(results: list, pages: int, repeat: int) -> list[dict]:
+    rows = len(mcc.OcrTable.from_results(results))
+    out = []
+    for streaming in (True, False):
+        mode = "streaming" if streaming else "workbook"
+        t = _timed(lambda: mcc.write_excel_from_ocr(results, io.BytesIO(), streaming=streaming),
+                   repeat)
+        out.append({"bench": "excel", "pages": pages, "mode": mode, "rows": rows, **t})
+    return out
+
+
+# ─── Storage & comparison ────────────────────────────────────────────────
+_KEY_FIELDS = ("bench", "pages", "chunk_size", "parallel", "strategy", "mode")
+
+
+def _key(row: dict) -> tuple:
+    return tuple(row.get(k) for k in _KEY_FIELDS)
+
+
+def _git_sha() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "nogit"
+
+
+def compare(current: list[dict], baseline_path: str, tolerance: float) -> int:
+    """Print median deltas against *baseline_path*; return the regression count."""
+    with open(baseline_path, "r", encoding="utf-8") as fh:
+        baseline = {_key(r): r for r in json.load(fh)["results"]}
+    regressions = 0
+    print(f"\nCompared with {baseline_path} (tolerance {tolerance:.0%}):")
+    for row in current:
+        old = baseline.get(_key(row))
+        if not old or not old.get("median_s"):
+            continue
+        ratio = row["median_s"] / old["median_s"]
+        flag  = ""
+        if ratio > 1 + tolerance:
+            flag, regressions = "  ← REGRESSION", regressions + 1
+        label = " ".join(f"{k}={row[k]}" for k in _KEY_FIELDS[1:] if row.get(k) is not None)
+        print(f"  {row['bench']:<6} {label:<48} {old['median_s']:9.4f}s → "
+              f"{row['median_s']:9.4f}s  {ratio - 1:+7.1%}{flag}")
+    return regressions
+
+
+def _ints(text: str) -> list[int]:
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0],
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--pages", type=_ints, default=[10, 50, 200])
+    ap.add_argument("--chunk-sizes", type=_ints, default=[2, 4, 8])
+    ap.add_argument("--parallel", type=_ints, default=[4, 10])
+    ap.add_argument("--strategies", default="fixed",
+                    type=lambda s: [x for x in s.split(",") if x])
+    ap.add_argument("--latency", type=float, default=0.2, help="stub base latency (s)")
+    ap.add_argument("--per-page", type=float, default=0.02, help="stub latency per page (s)")
+    ap.add_argument("--jitter", type=float, default=0.05, help="± uniform jitter (s)")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of HTTP 503s")
+    ap.add_argument("--rows-per-page", type=int, default=5)
+    ap.add_argument("--lines", type=int, default=40, help="text lines per synthetic page")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", default="bench_results")
+    ap.add_argument("--compare", metavar="BASELINE.json")
+    ap.add_argument("--tolerance", type=float, default=0.15)
+    args = ap.parse_args(argv)
+
+    random.seed(args.seed)                     # backoff jitter in mcc
+    mcc.logger.setLevel("ERROR")               # per-chunk and retry lines drown the table
+    mcc.BACKOFF_BASE = min(mcc.BACKOFF_BASE, 0.1)
+    knobs = (mcc.CHUNK_STRATEGY, mcc.CHUNK_SIZE_PAGES, mcc.MAX_PARALLEL, mcc.FRACTO_ENDPOINT,
+             mcc.latency_model)
+    rows: list[dict] = []
+    with tempfile.TemporaryDirectory() as tmp, FractoStub(
+            args.latency, args.per_page, args.jitter, args.error_rate,
+            args.rows_per_page, args.seed) as stub:
+        # Never train the user's persisted latency model on stub timings
+        mcc.latency_model   = mcc.LatencyModel(Path(tmp) / "latency.json")
+        mcc.FRACTO_ENDPOINT = stub.url
+        try:
+            # Warm-up: lazy imports, engine loop and keep-alive connections
+            # would otherwise be billed to whichever case happens to run first.
+            warm = mcc.call_fracto_parallel(make_pdf(2, 2), "warm-up.pdf")
+            mcc.write_excel_from_ocr(warm, io.BytesIO(), streaming=False)
+            for pages in args.pages:
+                pdf = make_pdf(pages, args.lines, seed=args.seed)
+                print(f"{pages} page(s), {len(pdf) / 1024:.0f} KiB", flush=True)
+                rows += bench_split(pdf, pages, args.chunk_sizes, args.repeat)
+                e2e, results = bench_e2e(pdf, pages, stub, args.chunk_sizes, args.parallel,
+                                         args.strategies, args.repeat)
+                rows += e2e
+                rows += bench_excel(results, pages, args.repeat)
+        finally:
+            (mcc.CHUNK_STRATEGY, mcc.CHUNK_SIZE_PAGES, mcc.MAX_PARALLEL,
+             mcc.FRACTO_ENDPOINT, mcc.latency_model) = knobs
+
+    for row in rows:
+        if row["bench"] != "e2e":
+            extra = " ".join(f"{k}={row[k]}" for k in ("chunk_size", "mode", "rows") if k in row)
+            print(f"  {row['bench']:<6} {row['pages']:>5}p  {extra:<28} {row['median_s']:9.4f}s")
+
+    sha = _git_sha()
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_sha":   sha,
+            "python":    platform.python_version(),
+            "platform":  platform.platform(),
+            "cpus":      os.cpu_count(),
+            "args":      vars(args),
+        },
+        "results": rows,
+    }
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    path = out_dir / f"bench-{datetime.now():%Y%m%d-%H%M%S}-{sha}.json"
+    path.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"\nResults written to {path}")
+
+    if args.compare:
+        return 1 if compare(rows, args.compare, args.tolerance) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
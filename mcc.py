@@ -1,150 +1,859 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+#!/usr/bin/env python
+"""
+fracto_page_ocr.py
+──────────────────
+Split a PDF page-by-page and pipe each page through Fracto Smart-OCR.
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import time
+import random
+import hashlib
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+from typing import List, Dict, Any, Iterator
+import functools
+import itertools
+
+# openpyxl, PyPDF2, httpx and yaml are imported where they are first needed
+# so `import mcc` (CLI --help, app start-up, batch workers) stays cheap –
+# check with `python mcc.py --import-time`.
 
+# ─── Chunk planning ──────────────────────────────────────────────────────
 CHUNK_SIZE_PAGES = 4
 MAX_PARALLEL     = 10
 MIN_TAIL_COMBINE   = 3
 
-def _split_pdf_bytes(pdf_bytes: bytes,
-                     chunk_size: int = CHUNK_SIZE_PAGES,
-                     min_tail: int = MIN_TAIL_COMBINE) -> list[bytes]:
+def _chunk_ranges(total: int,
+                  chunk_size: int = CHUNK_SIZE_PAGES,
+                  min_tail: int = MIN_TAIL_COMBINE) -> list[range]:
     """
-    Return a list of PDF byte-chunks. Keeps 5-page blocks, *except* that a final
-    fragment < min_tail pages is merged into the previous chunk so it retains
-    invoice context (e.g. 26 pages → 5,5,5,5,6 instead of 5,5,5,5,5,1).
+    Plan chunk boundaries up front. Keeps *chunk_size*-page blocks, *except*
+    that a final fragment < min_tail pages is merged into the previous chunk
+    so it retains invoice context (e.g. 26 pages → 5,5,5,5,6 instead of
+    5,5,5,5,5,1). Each chunk can then be serialized exactly once.
     """
-    reader = PdfReader(io.BytesIO(pdf_bytes))
-    total  = len(reader.pages)
     if total <= chunk_size:
-        return [pdf_bytes]
-
-    chunks: list[bytes] = []
-    start = 0
-    while start < total:
-        end = min(start + chunk_size, total)
-        # If this is the *last* chunk and it is tiny → back-merge with previous.
-        if total - start < min_tail and chunks:
-            # Append the remaining pages to the previous writer
-            prev_buf = io.BytesIO(chunks.pop())          # last chunk bytes
-            prev_reader = PdfReader(prev_buf)
-            writer = PdfWriter()
-            # re-copy pages of previous chunk
-            for p in prev_reader.pages:
-                writer.add_page(p)
-            # add the tail pages
-            for p in range(start, total):
-                writer.add_page(reader.pages[p])
-            buf = io.BytesIO()
-            writer.write(buf)
-            chunks.append(buf.getvalue())
-            break   # finished
+        return [range(0, total)]
+    ranges = [range(s, min(s + chunk_size, total)) for s in range(0, total, chunk_size)]
+    if len(ranges) > 1 and len(ranges[-1]) < min_tail:
+        tail = ranges.pop()
+        ranges[-1] = range(ranges[-1].start, tail.stop)
+    return ranges
+
+def _adaptive_ranges(costs: list[float],
+                     workers: int = MAX_PARALLEL,
+                     max_pages: int = 0,
+                     min_tail: int = MIN_TAIL_COMBINE) -> list[range]:
+    """
+    Plan contiguous chunks of roughly equal *estimated cost* instead of equal
+    page count, so one heavy scan doesn't dominate the document's latency.
+
+    Aims for one chunk per worker, binary-searching the smallest per-chunk
+    cost cap that fits. A chunk is never closed below *min_tail* pages nor
+    grown past *max_pages*, and a short final fragment is folded back into
+    its predecessor – the same invoice-context rule as `MIN_TAIL_COMBINE` –
+    or, where that would exceed *max_pages*, shares its pages evenly.
+    """
+    total     = len(costs)
+    max_pages = max_pages or 2 * CHUNK_SIZE_PAGES
+    if total <= min_tail:
+        return [range(0, total)]
+    n = max(1, min(workers, total // max(min_tail, 1)))
+    n = max(n, -(-total // max_pages))
+
+    def _pack(cap: float) -> list[range]:
+        out, start, acc = [], 0, 0.0
+        for i, c in enumerate(costs):
+            size = i - start
+            if size >= max_pages or (acc + c > cap and size >= min_tail):
+                out.append(range(start, i))
+                start, acc = i, 0.0
+            acc += c
+        if out and total - start < min_tail:
+            prev = out.pop()
+            if total - prev.start <= max_pages:
+                out.append(range(prev.start, total))
+            else:                          # too long to fold: split the two evenly
+                mid = prev.start + (total - prev.start) // 2
+                out += [range(prev.start, mid), range(mid, total)]
+        else:
+            out.append(range(start, total))
+        return out
+
+    lo, hi = max(costs), sum(costs)
+    for _ in range(40):
+        mid = (lo + hi) / 2
+        if len(_pack(mid)) <= n:
+            hi = mid
         else:
-            writer = PdfWriter()
-            for p in range(start, end):
-                writer.add_page(reader.pages[p])
-            buf = io.BytesIO()
-            writer.write(buf)
-            chunks.append(buf.getvalue())
-            start = end
+            lo = mid
+    return _pack(hi)
+
+def _split_pdf_bytes(pdf: "bytes | PdfDocument",
+                     chunk_size: int = CHUNK_SIZE_PAGES,
+                     min_tail: int = MIN_TAIL_COMBINE) -> list[bytes]:
+    """
+    Return a list of PDF byte-chunks following `_chunk_ranges`. Accepts raw
+    bytes or an already parsed `PdfDocument` (which is then not re-parsed).
+    """
+    doc = pdf if isinstance(pdf, PdfDocument) else PdfDocument(pdf)
+    return doc.split(chunk_size, min_tail)
+
 
-    return chunks
+# ─── PDF handling ─────────────────────────────────────────────────────
+# Large-document mode, for sources of FRACTO_LARGE_DOC_MB or more: a PDF
+# given by path stays on disk behind one read handle, the reader forgets
+# parsed objects after every chunk, and chunks are spooled to anonymous
+# temp files that httpx streams into the upload. Peak memory is then set by
+# MAX_PARALLEL × chunk size rather than by the page count.
+LARGE_DOC_BYTES = int(float(os.getenv("FRACTO_LARGE_DOC_MB", "32")) * 1024 * 1024)
+SPOOL_DIR       = os.getenv("FRACTO_SPOOL_DIR") or None      # default: system temp
 
-def call_fracto_parallel(pdf_bytes: bytes, file_name: str) -> list[dict]:
+
+class ChunkFile:
     """
-    If the PDF is ≤ chunk_size_pages, behaves like `call_fracto` (returns [single‑result]).
-    If more, splits into chunk_size_pages page chunks and hits the Fracto API concurrently with
-    up to `MAX_PARALLEL` workers. Results are returned in order of the chunks.
+    Chunk bytes that live in a file instead of memory.
+
+    Has a ``len`` like bytes, is hashed block by block (`blocks` uses
+    ``pread``, so it never moves the handle httpx reads from) and is closed
+    – i.e. deleted, for spooled temp files – once its upload is done.
     """
-    chunks = _split_pdf_bytes(pdf_bytes, CHUNK_SIZE_PAGES)
-    if len(chunks) == 1:
-        return [call_fracto(pdf_bytes, file_name)]
 
-    logger.info("Splitting %s into %d chunks of %d pages each", file_name, len(chunks), CHUNK_SIZE_PAGES)
+    def __init__(self, fh, size: int):
+        self.fh   = fh
+        self.size = size
 
-    results: list[dict] = [None] * len(chunks)
+    @classmethod
+    def spool(cls, write) -> "ChunkFile":
+        """Create an anonymous temp file and let *write(fh)* fill it."""
+        fh = tempfile.TemporaryFile(dir=SPOOL_DIR)
+        try:
+            write(fh)
+            fh.flush()
+        except BaseException:
+            fh.close()
+            raise
+        return cls(fh, fh.tell())
 
-    with ThreadPoolExecutor(max_workers=MAX_PARALLEL) as pool:
-        futures = {
-            pool.submit(call_fracto, chunk, f"{file_name} (part {i+1})"): i
-            for i, chunk in enumerate(chunks)
-        }
-        for fut in as_completed(futures):
-            idx = futures[fut]
-            try:
-                results[idx] = fut.result()
-            except Exception as exc:
-                logger.error("Chunk %d failed: %s", idx + 1, exc)
-                results[idx] = {"file": file_name, "status": "error", "error": str(exc)}
+    def __len__(self) -> int:
+        return self.size
 
-    _renumber_serials(results)
-    return results
-#!/usr/bin/env python
-"""
-fracto_page_ocr.py
-──────────────────
-Split a PDF page-by-page and pipe each page through Fracto Smart-OCR.
-"""
+    def blocks(self, block: int = 1 << 20) -> Iterator[bytes]:
+        fd = self.fh.fileno()
+        for offset in range(0, self.size, block):
+            yield os.pread(fd, min(block, self.size - offset), offset)
 
-import io
-import os
-import sys
-import json
-import time
-import logging
-from pathlib import Path
-from typing import List, Dict, Any
+    def read_bytes(self) -> bytes:
+        return b"".join(self.blocks())
+
+    def close(self) -> None:
+        self.fh.close()
 
-from openpyxl import Workbook, load_workbook
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
-import yaml
 
-import requests
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
+def _blocks(data: "bytes | ChunkFile") -> Iterator[bytes]:
+    return data.blocks() if isinstance(data, ChunkFile) else iter((data,))
+
+
+def _sha256(data: "bytes | ChunkFile") -> str:
+    h = hashlib.sha256()
+    for block in _blocks(data):
+        h.update(block)
+    return h.hexdigest()
+
+
+def _upload_body(data: "bytes | ChunkFile"):
+    """What httpx gets as the multipart file: bytes, or the open handle to stream."""
+    return data.fh if isinstance(data, ChunkFile) else data
+
+
+class PdfDocument:
+    """
+    A PDF parsed once and shared by page counting, stamping and splitting.
+
+    Stamping only records the job number; it is applied while pages are
+    written, and bytes are produced solely by `write` / `split` /
+    `to_bytes`, so each chunk is serialized exactly once no matter how many
+    steps touched the document.
+
+    *source* is the PDF's bytes or a path. ``large`` (default: source of at
+    least LARGE_DOC_BYTES) switches to large-document mode: a path is read
+    lazily from disk instead of being loaded, and `chunk_bytes` returns
+    spooled `ChunkFile` objects. Call `close` when done with a path source.
+
+    Not thread-safe: the reader (and, in large mode, its one file handle and
+    object cache) is shared, so serialize calls that read pages – e.g. one
+    `iter_chunks` consumer, or a lock around `chunk_bytes`.
+    """
+
+    def __init__(self, source: "bytes | str | Path", *, large: bool | None = None):
+        from PyPDF2 import PdfReader
+        self.path: Path | None = None
+        self._fh = None
+        if isinstance(source, (str, Path)):
+            self.path = Path(source).expanduser()
+            self._size = self.path.stat().st_size
+        else:
+            self._size = len(source)
+        self.large = self._size >= LARGE_DOC_BYTES if large is None else large
+        if self.path is not None:
+            if self.large:
+                self._fh = open(self.path, "rb")
+                source = None
+            else:
+                source = self.path.read_bytes()
+        self._source = source
+        try:
+            with _stage("parse"):
+                self.reader = PdfReader(self._fh or io.BytesIO(source))
+                self.pages  = list(self.reader.pages)
+        except BaseException:
+            self.close()
+            raise
+        self.job_no: str | None = None
+        self.margin  = 0
+
+    def close(self) -> None:
+        """Release the file handle of a large path source (no-op otherwise)."""
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _release_objects(self) -> None:
+        """
+        Large mode: drop the reader's cache of parsed objects (content
+        streams, images, fonts …), which otherwise grows to the size of the
+        whole file; whatever a later chunk needs is re-read from the source.
+        The page dictionaries themselves stay referenced by ``self.pages``.
+        """
+        if self.large:
+            self.reader.resolved_objects.clear()
+
+    @property
+    def page_count(self) -> int:
+        return len(self.pages)
+
+    @property
+    def modified(self) -> bool:
+        return self.job_no is not None
+
+    def stamp_job_number(self, job_no: str, margin: int = 20) -> "PdfDocument":
+        """
+        Add an extra *margin* (pt) to the top of every page and stamp
+        'Job Number: <job_no>' inside that space, so the stamp never covers
+        the original page content. Returns *self* for chaining.
+
+        Stamping is lazy: it is fused into `write`, so a stamped document is
+        serialized once (per chunk) instead of being rewritten in full first.
+        """
+        if not job_no:
+            return self
+        if self.job_no is not None:
+            raise ValueError(f"document already stamped with job number {self.job_no!r}")
+        self.job_no = job_no
+        self.margin = margin
+        return self
+
+    def _stamped_page(self, orig_page, writer: "PdfWriter", shared: dict):
+        """
+        Build the stamped version of *orig_page* without parsing its content.
+
+        The new page wraps the original content streams (by reference) in a
+        ``q … cm … Q`` shift and appends one text overlay stream. The shift
+        stream, the Helvetica-Bold font and one overlay per distinct page
+        size are created once per *writer* and shared by its pages. Fixed
+        resource names keep the output byte-for-byte reproducible, so stamped
+        chunks still hit `ocr_cache`.
+        """
+        from PyPDF2.generic import (ArrayObject, DecodedStreamObject,
+                                    DictionaryObject, NameObject)
+
+        def _stream(data: bytes):
+            obj = DecodedStreamObject()
+            obj.set_data(data)
+            return writer._add_object(obj)
+
+        margin = self.margin
+        w = float(orig_page.mediabox.width)
+        h = float(orig_page.mediabox.height)
+
+        if "shift" not in shared:
+            shared["shift"] = _stream(f"q 1 0 0 1 0 {-margin} cm\n".encode())
+            shared["font"]  = writer._add_object(DictionaryObject({
+                NameObject("/Type"):     NameObject("/Font"),
+                NameObject("/Subtype"):  NameObject("/Type1"),
+                NameObject("/BaseFont"): NameObject("/Helvetica-Bold"),
+                NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+            }))
+        overlay = shared.get((w, h))
+        if overlay is None:
+            text = f"Job Number: {self.job_no}".encode("cp1252", "replace")
+            text = text.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+            overlay = shared[(w, h)] = _stream(
+                b"\nQ\nq BT /FxJobStamp 10 Tf 40 %g Td (" % (h + margin - 15)
+                + text + b") Tj ET Q\n"
+            )
+
+        contents = orig_page.get("/Contents")
+        if contents is None:
+            contents = []
+        elif not isinstance(contents.get_object(), ArrayObject):
+            contents = [contents]
+        else:
+            contents = list(contents.get_object())
+
+        resources = orig_page.get("/Resources")
+        resources = DictionaryObject(resources.get_object() if resources else {})
+        fonts = resources.get("/Font")
+        fonts = DictionaryObject(fonts.get_object() if fonts else {})
+        fonts[NameObject("/FxJobStamp")] = shared["font"]
+        resources[NameObject("/Font")] = fonts
+
+        from PyPDF2 import PageObject
+        new_page = PageObject.create_blank_page(None, w, h + margin)
+        new_page[NameObject("/Resources")] = resources
+        new_page[NameObject("/Contents")]  = ArrayObject([shared["shift"], *contents, overlay])
+        if "/Annots" in orig_page:
+            new_page[NameObject("/Annots")] = orig_page["/Annots"]
+        return new_page
+
+    def write(self, pages: range) -> bytes:
+        """Serialize the given page range as a standalone PDF."""
+        buf = io.BytesIO()
+        self._write_into(pages, buf)
+        return buf.getvalue()
+
+    def _write_into(self, pages: range, stream) -> None:
+        from PyPDF2 import PdfWriter
+        writer = PdfWriter()
+        shared: dict = {}
+        stamping = 0.0
+        for i in pages:
+            page = self.pages[i]
+            if self.job_no is not None:
+                t0 = time.perf_counter()
+                page = self._stamped_page(page, writer, shared)
+                stamping += time.perf_counter() - t0
+            writer.add_page(page)
+        if self.job_no is not None:
+            _observe("stage_seconds", stamping, stage="stamp")
+        writer.write(stream)
+
+    def to_bytes(self) -> bytes:
+        if not self.modified:
+            return self._source if self._source is not None else self.path.read_bytes()
+        return self.write(range(self.page_count))
+
+    def page_bytes(self, i: int) -> int:
+        """
+        Cheap size proxy for page *i*: encoded length of its content streams
+        plus any image XObjects it draws. Nothing is decompressed.
+        """
+        def _raw_len(obj) -> int:
+            # Length of the still-encoded stream data (no filter decoding).
+            return len(getattr(obj.get_object(), "_data", b"") or b"")
+
+        page  = self.pages[i]
+        total = 0
+        contents = page.get("/Contents")
+        if contents is not None:
+            contents = contents.get_object()
+            for part in (contents if isinstance(contents, list) else [contents]):
+                total += _raw_len(part)
+        try:
+            xobjects = page["/Resources"]["/XObject"]
+        except (KeyError, TypeError):
+            xobjects = {}
+        for ref in xobjects.values():
+            xo = ref.get_object()
+            if xo.get("/Subtype") == "/Image":
+                total += _raw_len(xo)
+        return total
+
+    def page_costs(self, span: "range | list[int] | None" = None) -> list[float]:
+        """Estimated OCR seconds per page (of *span*), from `latency_model`."""
+        span  = range(self.page_count) if span is None else span
+        costs = [latency_model.page_cost(self.page_bytes(i)) for i in span]
+        self._release_objects()
+        return costs
+
+    def page_fingerprint(self, i: int) -> str:
+        """
+        Content hash of page *i*: page box and rotation, the still-encoded
+        content streams, and the XObjects (one level of nested forms) and
+        fonts it references. Repeated pages hash equal even when the file
+        stores them as separate objects; nothing is decoded or rendered.
+        """
+        def _get(obj, key: str):
+            # dict.get on PyPDF2 dictionaries does not resolve references
+            value = obj.get(key)
+            return value.get_object() if value is not None else None
+
+        def _raw(obj) -> bytes:
+            return getattr(obj.get_object(), "_data", b"") or b""
+
+        def _resources(res, h, depth: int) -> None:
+            if res is None:
+                return
+            for name, ref in sorted((_get(res, "/XObject") or {}).items()):
+                xo = ref.get_object()
+                h.update(f"{name}{_get(xo, '/Subtype')}".encode())
+                h.update(_raw(xo))
+                if depth and _get(xo, "/Subtype") == "/Form":
+                    _resources(_get(xo, "/Resources"), h, depth - 1)
+            for name, ref in sorted((_get(res, "/Font") or {}).items()):
+                h.update(f"{name}{_get(ref.get_object(), '/BaseFont')}".encode())
+
+        page = self.pages[i]
+        h = hashlib.sha256()
+        h.update(repr([float(x) for x in page.mediabox]).encode())
+        h.update(str(_get(page, "/Rotate") or 0).encode())
+        contents = _get(page, "/Contents")
+        if contents is not None:
+            for part in (contents if isinstance(contents, list) else [contents]):
+                h.update(_raw(part))
+        _resources(_get(page, "/Resources"), h, 1)
+        return h.hexdigest()
+
+    def page_fingerprints(self) -> list[str]:
+        fps = [self.page_fingerprint(i) for i in range(self.page_count)]
+        self._release_objects()
+        return fps
+
+    def scan_page(self, i: int) -> SimpleNamespace:
+        """
+        Cheap look at page *i*'s text layer without rendering it: the shown
+        strings (``text``), their non-blank character count (``glyphs``),
+        painted images (``images``, XObject and inline ``BI … EI`` images)
+        and path operators (``paths``). Forms
+        are followed one level deep. Strings are read straight from the
+        content stream; only pages using hex-encoded (usually CID) strings
+        fall back to PyPDF2's slower text extraction for ``text``.
+        """
+        def _get(obj, key: str):
+            value = obj.get(key)
+            return value.get_object() if value is not None else None
+
+        def _scan(data: bytes, res, out: SimpleNamespace, depth: int) -> None:
+            if b"ID" in data:                  # inline images: count, then drop the binary data
+                data, n = _INLINE_IMAGE_RE.subn(b" ", data)
+                out.images += n
+            for m in _TEXT_OP_RE.finditer(data):
+                array = m.group(1)
+                parts = _PDF_STRING_RE.findall(array) if array is not None else [m.group(2)]
+                out.hex   |= any(p[:1] == b"<" for p in parts)
+                shown      = "".join(_pdf_string(p) for p in parts)
+                out.glyphs += len("".join(shown.split()))
+                out.text.append(shown)
+            out.paths += len(_PATH_OP_RE.findall(data))   # may overcount inside strings
+            xobjects = (_get(res, "/XObject") or {}) if res is not None else {}
+            for name in _DO_OP_RE.findall(data):
+                xo = xobjects.get(name.decode("latin-1"))
+                xo = xo.get_object() if xo is not None else None
+                if xo is None:
+                    continue
+                if _get(xo, "/Subtype") == "/Image":
+                    out.images += 1
+                elif depth and _get(xo, "/Subtype") == "/Form":
+                    _scan(xo.get_data(), _get(xo, "/Resources"), out, depth - 1)
+
+        page = self.pages[i]
+        out  = SimpleNamespace(text=[], glyphs=0, images=0, paths=0, hex=False)
+        contents = page.get_contents()
+        if contents is not None:
+            _scan(contents.get_data(), _get(page, "/Resources"), out, 1)
+        text = " ".join(out.text)
+        if out.hex:
+            try:
+                text = page.extract_text()
+            except Exception as exc:           # best effort: keep the raw strings
+                logger.debug("Text extraction failed on page %d: %s", i + 1, exc)
+        return SimpleNamespace(text=text, glyphs=out.glyphs, images=out.images, paths=out.paths)
+
+    def scan_pages(self) -> list[SimpleNamespace]:
+        with _stage("prescan"):
+            scans = [self.scan_page(i) for i in range(self.page_count)]
+        self._release_objects()
+        return scans
+
+    def chunk_ranges(self, chunk_size: int = CHUNK_SIZE_PAGES,
+                     min_tail: int = MIN_TAIL_COMBINE,
+                     strategy: str | None = None,
+                     span: "range | list[int] | None" = None) -> list[range]:
+        """
+        Plan chunk boundaries with the ``"fixed"`` (every *chunk_size* pages)
+        or ``"adaptive"`` (cost-balanced across MAX_PARALLEL workers)
+        strategy; defaults to CHUNK_STRATEGY. *span* limits planning to a
+        run of pages (chunks stay absolute page indices; a list *span* gives
+        list chunks).
+        """
+        strategy = strategy or CHUNK_STRATEGY
+        span = range(self.page_count) if span is None else span
+        if strategy == "adaptive":
+            ranges = _adaptive_ranges(self.page_costs(span), MAX_PARALLEL,
+                                      2 * chunk_size, min_tail)
+        elif strategy == "fixed":
+            ranges = _chunk_ranges(len(span), chunk_size, min_tail)
+        else:
+            raise ValueError(f"unknown chunk strategy {strategy!r}")
+        return [span[r.start:r.stop] for r in ranges]
+
+    def chunk_bytes(self, pages: range) -> "bytes | ChunkFile":
+        """
+        Bytes for one chunk; a whole untouched document is sent verbatim.
+        In large mode the chunk is a `ChunkFile` (the caller closes it).
+        """
+        with _stage("split"):
+            if len(pages) == self.page_count and not self.modified:
+                if self._source is None:
+                    return ChunkFile(open(self.path, "rb"), self._size)
+                return self._source
+            if not self.large:
+                return self.write(pages)
+            try:
+                return ChunkFile.spool(lambda fh: self._write_into(pages, fh))
+            finally:
+                self._release_objects()
+
+    def iter_chunks(self, ranges: list[range]) -> Iterator[bytes]:
+        """
+        Lazily serialize *ranges* one at a time, so a consumer can start
+        uploading chunk 1 while later chunks are still being written.
+        """
+        for r in ranges:
+            yield self.chunk_bytes(r)
+
+    def split(self, chunk_size: int = CHUNK_SIZE_PAGES,
+              min_tail: int = MIN_TAIL_COMBINE) -> list[bytes]:
+        out = []
+        for chunk in self.iter_chunks(self.chunk_ranges(chunk_size, min_tail)):
+            if isinstance(chunk, ChunkFile):
+                data = chunk.read_bytes()
+                chunk.close()
+                chunk = data
+            out.append(chunk)
+        return out
+
 
-# ─── PDF Stamping Helper ──────────────────────────────────────────────
 def stamp_job_number(src_bytes: bytes, job_no: str, margin: int = 20) -> bytes:
     """
     Return new PDF bytes with an extra *margin* (pt) added to the top
     of every page, then stamps 'Job Number: <job_no>' inside that space.
 
-    This ensures the stamp never covers the original page content.
+    Prefer `PdfDocument.stamp_job_number` when the document is about to be
+    split anyway – it skips the intermediate full rewrite.
     """
     if not job_no:
         return src_bytes
+    return PdfDocument(src_bytes).stamp_job_number(job_no, margin).to_bytes()
+
+# ─── Duplicate pages ─────────────────────────────────────────────────────
+# Bundles repeat pages (T&C sheets, cover sheets, invoice copies). With a
+# FRACTO_DEDUP policy, pages are fingerprinted before chunking and every
+# repeat becomes a one-page placeholder result instead of being uploaded:
+#   reuse – the first copy is OCR'd on its own (so its rows are known) and
+#           each repeat gets a copy of those rows
+#   drop  – repeats contribute no rows at all
+# FRACTO_DEDUP_RECENT > 0 also remembers that many page fingerprints across
+# documents processed by this process (e.g. a batch or the app's workers).
+DEDUP_POLICY = os.getenv("FRACTO_DEDUP", "off")                 # off | reuse | drop
+DEDUP_RECENT = int(os.getenv("FRACTO_DEDUP_RECENT", "0"))       # pages remembered
+
+
+class RecentPages:
+    """
+    Bounded LRU of page fingerprint → (where it was seen, OCR payload).
 
-    from PyPDF2 import PdfReader, PdfWriter, Transformation, PageObject
+    The payload is only known for pages that were OCR'd as a one-page chunk;
+    pages from larger chunks are remembered with ``None`` (enough for the
+    drop policy, and a hint for reuse to OCR them alone next time).
+    """
 
-    base_reader = PdfReader(io.BytesIO(src_bytes))
-    writer      = PdfWriter()
+    def __init__(self, capacity: int | None = None):
+        self._capacity = capacity                # None: follow DEDUP_RECENT
+        self._lock     = threading.Lock()
+        self._pages: dict[str, tuple[str, Any]] = {}
+
+    @property
+    def capacity(self) -> int:
+        return DEDUP_RECENT if self._capacity is None else self._capacity
+
+    def get(self, fp: str) -> tuple[str, Any] | None:
+        with self._lock:
+            hit = self._pages.pop(fp, None)
+            if hit is not None:
+                self._pages[fp] = hit            # most recently used last
+            return hit
+
+    def remember(self, fp: str, source: str, payload: Any = None) -> None:
+        if self.capacity <= 0:
+            return
+        if payload is not None:
+            import copy
+            payload = copy.deepcopy(payload)     # results get renumbered in place
+        with self._lock:
+            old = self._pages.pop(fp, None)
+            if payload is None and old is not None:
+                source, payload = old            # never forget known rows
+            self._pages[fp] = (source, payload)
+            while len(self._pages) > self.capacity:
+                del self._pages[next(iter(self._pages))]
+
+
+recent_pages = RecentPages()
+
+
+def _duplicate_result(file_name: str, policy: str, dupe: dict,
+                      original: dict | None = None) -> dict:
+    """Placeholder result for a repeated page (see `plan_chunks`)."""
+    import copy
+
+    if "recent" in dupe:
+        source, payload = f"recent: {dupe['recent']}", dupe["payload"]
+        status, error = "ok", None
+    else:
+        source  = f"page {dupe['page'] + 1}"
+        payload = original.get("data") if original else None
+        status  = original.get("status", "ok") if original else "ok"
+        error   = original.get("error") if original else None
+    result = {"file": file_name, "status": status, "duplicate_of": source, "dedup": policy}
+    if status != "ok":
+        result["error"] = f"first copy ({source}) failed: {error}"
+    else:
+        result["data"] = copy.deepcopy(payload) if policy == "reuse" and payload is not None else []
+    return result
+
+
+# ─── Page pre-scan ───────────────────────────────────────────────────────
+# With FRACTO_PRESCAN on, every page's text layer is read (see
+# `PdfDocument.scan_page`) before chunking:
+#   • blank separator pages – no images, hardly any vector paths and at
+#     most FRACTO_BLANK_MAX_CHARS visible characters – are not uploaded
+#   • a page matching FRACTO_INVOICE_PATTERN with a new invoice number
+#     starts an invoice, and chunks are cut between invoices (`_invoice_ranges`)
+#     – only there: a blank page inside an invoice is dropped from its chunk
+# Scanned pages have no text layer and are chunked as before.
+PRESCAN         = os.getenv("FRACTO_PRESCAN", "0").lower() not in ("0", "false", "no", "off")
+BLANK_MAX_CHARS = int(os.getenv("FRACTO_BLANK_MAX_CHARS", "32"))
+INVOICE_PATTERN = os.getenv("FRACTO_INVOICE_PATTERN",
+                            r"invoice\s*(?:no\b\.?|number|#)\s*[:#.]?\s*([A-Z0-9][\w/-]*)")
+_BLANK_MAX_PATHS = 64          # more path operators: outlined text or a drawing
+
+_PDF_STRING = (rb"\([^()\\]*(?:(?:\\.|\([^()\\]*(?:\\.[^()\\]*)*\))[^()\\]*)*\)"   # one nesting level
+               rb"|<[0-9A-Fa-f\s]*>")
+_PDF_STRING_RE = re.compile(_PDF_STRING, re.S)
+_TEXT_OP_RE    = re.compile(rb"\[((?:" + _PDF_STRING + rb"|[^\]()<])*)\]\s*TJ|("
+                            + _PDF_STRING + rb")\s*(?:Tj|'|\")", re.S)
+_PATH_OP_RE    = re.compile(rb"(?<![\w/])(?:re|[mlcvy])(?!\w)")
+_DO_OP_RE      = re.compile(rb"(/[^\s/\[\]()<>{}%]+)\s*Do\b")
+_INLINE_IMAGE_RE = re.compile(rb"(?<![\w/])BI(?!\w).*?(?<![\w/])ID\s.*?\sEI(?!\w)", re.S)
+_PDF_ESCAPES   = {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"\b", b"f": b"\f", b"\n": b""}
+
+
+def _pdf_string(token: bytes) -> str:
+    """Decode a literal ``(…)`` or hex ``<…>`` PDF string token (as Latin-1)."""
+    if token[:1] == b"<":
+        digits = re.sub(rb"\s", b"", token[1:-1])
+        return bytes.fromhex((digits + b"0" * (len(digits) % 2)).decode()).decode("latin-1")
+
+    if b"\\" not in token:
+        return token[1:-1].decode("latin-1")
+
+    def _escape(m) -> bytes:
+        seq = m.group(1)
+        if seq[:1].isdigit():
+            return bytes([int(seq, 8) & 0xFF])
+        return _PDF_ESCAPES.get(seq, seq)
+
+    return re.sub(rb"\\([0-7]{1,3}|.)", _escape, token[1:-1], flags=re.S).decode("latin-1")
+
+
+def _is_blank(scan: SimpleNamespace, max_chars: int | None = None) -> bool:
+    max_chars = BLANK_MAX_CHARS if max_chars is None else max_chars
+    return not scan.images and scan.paths <= _BLANK_MAX_PATHS and scan.glyphs <= max_chars
+
+
+def _invoice_starts(texts: list[str], pattern: str | None = None) -> set[int]:
+    """
+    Pages (0-based) that begin an invoice: the header pattern matches and its
+    first group (the invoice number, if the pattern has one) differs from
+    the previous matching page, so repeated headers on page 2 of the same
+    invoice don't count.
+    """
+    regex = re.compile(pattern or INVOICE_PATTERN, re.I)
+    starts, last = set(), None
+    for i, text in enumerate(texts):
+        m = regex.search(text)
+        if m is None:
+            continue
+        number = m.group(1).upper() if regex.groups and m.group(1) else None
+        if number is None or number != last:
+            starts.add(i)
+        last = number
+    return starts
+
+
+def _invoice_ranges(starts: list[int], total: int,
+                    chunk_size: int = CHUNK_SIZE_PAGES,
+                    min_tail: int = MIN_TAIL_COMBINE) -> list[range]:
+    """
+    Chunk *total* pages along invoice boundaries: whole invoices (pages from
+    one start to the next; anything before the first start counts as one)
+    are packed greedily into chunks of at most *chunk_size* pages. A single
+    invoice of up to 2 × *chunk_size* pages stays in one chunk; longer ones
+    fall back to `_chunk_ranges`.
+    """
+    bounds = sorted({0, total, *(s for s in starts if 0 < s < total)})
+    out: list[range] = []
+    cur: range | None = None
+    for a, b in zip(bounds, bounds[1:]):
+        if cur is not None and len(cur) + (b - a) <= chunk_size:
+            cur = range(cur.start, b)
+            continue
+        if cur is not None:
+            out.append(cur)
+            cur = None
+        if b - a <= 2 * chunk_size:
+            cur = range(a, b)
+        else:
+            out += [range(a + r.start, a + r.stop) for r in _chunk_ranges(b - a, chunk_size, min_tail)]
+    if cur is not None:
+        out.append(cur)
+    return out
 
-    for orig_page in base_reader.pages:
-        w = float(orig_page.mediabox.width)
-        h = float(orig_page.mediabox.height)
 
-        # 1️⃣  Create a new blank page taller by *margin*
-        new_page = PageObject.create_blank_page(None, w, h + margin)
+def plan_chunks(doc: "PdfDocument", policy: str = "off", prescan: bool = False,
+                chunk_size: int = CHUNK_SIZE_PAGES,
+                min_tail: int = MIN_TAIL_COMBINE,
+                recent: RecentPages | None = None
+                ) -> tuple[list["range | list[int]"], dict[int, dict], list[str]]:
+    """
+    Chunk plan that skips what need not be uploaded.
+
+    Returns ``(ranges, skips, fingerprints)``. *ranges* covers every page in
+    order, like `PdfDocument.chunk_ranges`, but a chunk never spans a
+    repeated page. ``skips[slot]`` marks a slot that is not uploaded:
+
+    * dedup *policy* ``reuse`` / ``drop`` – a one-page slot holding
+      ``{"page": i}`` (0-based first copy, plus its ``"slot"`` under reuse)
+      or ``{"recent": source, "payload": …}``; fingerprints are returned
+      for `RecentPages`
+    * *prescan* – ``{"blank": n}`` for a run of n blank pages between
+      chunks; runs that contain invoice starts are cut with `_invoice_ranges`
+
+    Blank pages are never chunk boundaries: one that falls inside a chunk
+    (say, the empty back of an invoice's first page) is left out of it, and
+    that chunk is a list of page indices instead of a `range`.
+    """
+    if policy not in ("off", "reuse", "drop"):
+        raise ValueError(f"unknown dedup policy {policy!r} (expected off, reuse or drop)")
+    total = doc.page_count
+    blank: set[int] = set()
+    starts: set[int] = set()
+    if prescan:
+        scans  = doc.scan_pages()
+        starts = _invoice_starts([s.text for s in scans])
+        blank  = {i for i, s in enumerate(scans) if i not in starts and _is_blank(s)}
+
+    fps = doc.page_fingerprints() if policy != "off" else []
+    first: dict[str, int] = {}
+    dup:   dict[int, dict] = {}
+    isolate: set[int] = set()
+    for i, fp in enumerate(fps):
+        if i in blank:
+            continue
+        if fp in first:
+            dup[i] = {"page": first[fp]}
+            if policy == "reuse":
+                isolate.add(first[fp])
+            continue
+        hit = recent.get(fp) if recent is not None else None
+        if hit is not None and (policy == "drop" or hit[1] is not None):
+            dup[i] = {"recent": hit[0], "payload": hit[1]}
+            continue
+        first[fp] = i
+        if hit is not None:                   # seen before, rows unknown: OCR alone
+            isolate.add(i)
+
+    def _run_ranges(run: list[int]) -> list["range | list[int]"]:
+        span  = _page_run(run)
+        inner = [k for k, page in enumerate(run) if page in starts]
+        if not inner:
+            return [_page_run(c) for c in doc.chunk_ranges(chunk_size, min_tail, span=span)]
+        return [_page_run(span[r.start:r.stop])
+                for r in _invoice_ranges(inner, len(span), chunk_size, min_tail)]
+
+    ranges: list["range | list[int]"] = []
+    skips: dict[int, dict] = {}
+    slot_of: dict[int, int] = {}
+
+    def _skip_blank(i: int) -> None:
+        last = len(ranges) - 1
+        if "blank" in skips.get(last, {}) and ranges[last].stop == i:
+            ranges[last] = range(ranges[last].start, i + 1)
+            skips[last]["blank"] += 1
+        else:
+            skips[len(ranges)] = {"blank": 1}
+            ranges.append(range(i, i + 1))
+
+    def _flush(run: list[int], held: list[int]) -> None:
+        # Blank pages inside a chunk's span are left out of that chunk; the
+        # ones between chunks become skipped slots of their own.
+        held = iter(held)
+        page = next(held, None)
+        for chunk in (_run_ranges(run) if run else []):
+            while page is not None and page < chunk[0]:
+                _skip_blank(page)
+                page = next(held, None)
+            while page is not None and page < chunk[-1]:
+                page = next(held, None)
+            ranges.append(chunk)
+        while page is not None:
+            _skip_blank(page)
+            page = next(held, None)
+
+    run: list[int] = []
+    held: list[int] = []
+    for i in range(total):
+        if i in blank:
+            held.append(i)
+        elif i in dup or i in isolate:
+            _flush(run, held)
+            run, held = [], []
+            if i in dup:
+                if "page" in dup[i] and policy == "reuse":
+                    dup[i]["slot"] = slot_of[dup[i]["page"]]
+                skips[len(ranges)] = dup[i]
+            slot_of[i] = len(ranges)
+            ranges.append(range(i, i + 1))
+        else:
+            run.append(i)
+    _flush(run, held)
+    return ranges, skips, fps
 
-        # 2️⃣  Shift original page content down by `margin`
-        orig_page.add_transformation(Transformation().translate(tx=0, ty=-margin))
-        new_page.merge_page(orig_page)
 
-        # 3️⃣  Create text overlay the same enlarged size
-        overlay_buf = io.BytesIO()
-        c = canvas.Canvas(overlay_buf, pagesize=(w, h + margin))
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(40, h + margin - 15, f"Job Number: {job_no}")
-        c.save()
-        overlay_buf.seek(0)
+def _page_run(pages: "range | list[int]") -> "range | list[int]":
+    """*pages* as a `range` when they are consecutive, else as a list."""
+    if isinstance(pages, range) or not pages or pages[-1] - pages[0] + 1 != len(pages):
+        return pages
+    return range(pages[0], pages[-1] + 1)
 
-        overlay_reader = PdfReader(overlay_buf)
-        new_page.merge_page(overlay_reader.pages[0])
 
-        # 4️⃣  Add to writer
-        writer.add_page(new_page)
+def _blank_result(file_name: str) -> dict:
+    """Placeholder result for a run of blank pages (see `plan_chunks`)."""
+    return {"file": file_name, "status": "ok", "data": [], "skipped": "blank"}
 
-    out_buf = io.BytesIO()
-    writer.write(out_buf)
-    return out_buf.getvalue()
 
 # ─── CONFIG ──────────────────────────────────────────────────────────────
 # Allow overriding the endpoint via env var `FRACTO_ENDPOINT`.
@@ -158,6 +867,18 @@ PARSER_APP_ID   = "Tua4jrrYqLmCi7jt"
 MODEL_ID        = "tv6"
 EXTRA_ACCURACY  = "true"
 
+# HTTP transport: connect/read timeouts are split so a dead host fails fast
+# while a slow OCR job still gets its full read window.
+CONNECT_TIMEOUT = float(os.getenv("FRACTO_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT    = float(os.getenv("FRACTO_READ_TIMEOUT", "600"))
+MAX_RETRIES     = int(os.getenv("FRACTO_MAX_RETRIES", "3"))
+BACKOFF_BASE    = float(os.getenv("FRACTO_BACKOFF_BASE", "1.0"))   # seconds
+BACKOFF_MAX     = float(os.getenv("FRACTO_BACKOFF_MAX", "30"))     # seconds
+# Process-wide cap on concurrent uploads across *all* documents; MAX_PARALLEL
+# still limits how many chunks of a single document run at once.
+MAX_IN_FLIGHT   = int(os.getenv("FRACTO_MAX_IN_FLIGHT", "64"))
+RETRY_STATUSES  = frozenset({429, 500, 502, 503, 504})
+
 # ──────────────────────────────────────────────────────────────────────────
 
 logger = logging.getLogger("FractoPageOCR")
@@ -166,9 +887,466 @@ logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
     datefmt="%H:%M:%S",
 )
+logging.getLogger("httpx").setLevel(logging.WARNING)   # one line per chunk is enough
+
+
+# ─── OCR result cache ─────────────────────────────────────────────────────
+# Content-addressed: the key is a SHA-256 over the chunk bytes *and* the
+# parser settings, so changing PARSER_APP_ID / MODEL_ID / EXTRA_ACCURACY
+# never serves a stale extraction. Set FRACTO_CACHE=0 to bypass entirely.
+CACHE_ENABLED   = os.getenv("FRACTO_CACHE", "1").lower() not in ("0", "false", "no", "off")
+CACHE_DIR       = Path(os.getenv("FRACTO_CACHE_DIR", "~/.cache/fracto-ocr")).expanduser()
+CACHE_MAX_BYTES = int(float(os.getenv("FRACTO_CACHE_MAX_MB", "512")) * 1024 * 1024)
+CACHE_MAX_AGE_S = float(os.getenv("FRACTO_CACHE_MAX_AGE_DAYS", "30")) * 86400
+
+
+class OcrCache:
+    """
+    Persistent on-disk cache of Fracto responses.
+
+    Entries live at ``<root>/<key[:2]>/<key>.json`` and hold only the parsed
+    ``data`` payload. Writes go through a temp file + ``os.replace`` so
+    readers in other threads/processes never see a half-written entry.
+    A hit refreshes the file mtime, which makes size-based eviction LRU;
+    entries older than *max_age* seconds are dropped on read and on sweep.
+    """
+
+    def __init__(self, root: Path, max_bytes: int = CACHE_MAX_BYTES,
+                 max_age: float = CACHE_MAX_AGE_S):
+        self.root      = Path(root)
+        self.max_bytes = max_bytes
+        self.max_age   = max_age
+        self._lock     = threading.Lock()
+        self._size: int | None = None      # lazily measured on first put
+
+    @staticmethod
+    def key(file_bytes: "bytes | ChunkFile") -> str:
+        h = hashlib.sha256()
+        h.update(f"{PARSER_APP_ID}\0{MODEL_ID}\0{EXTRA_ACCURACY}\0".encode())
+        for block in _blocks(file_bytes):
+            h.update(block)
+        return h.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Any | None:
+        path = self._path(key)
+        try:
+            st = path.stat()
+            if self.max_age and time.time() - st.st_mtime > self.max_age:
+                self._discard(path, st.st_size)
+                return None
+            with open(path, "r", encoding="utf-8") as fh:
+                payload = json.load(fh)
+            os.utime(path)                  # mark as recently used
+            return payload
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exc:
+            logger.warning("Ignoring unreadable cache entry %s: %s", path.name, exc)
+            return None
+
+    def put(self, key: str, payload: Any) -> None:
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                json.dump(payload, fh)
+            size = os.path.getsize(tmp)
+            try:                               # re-put of a cached key: count the change only
+                size -= path.stat().st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, path)
+        except OSError as exc:
+            logger.warning("Could not write cache entry %s: %s", path.name, exc)
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(st.st_size for _, st in self._entries())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for path in self.root.glob("*/*.json"):
+            try:
+                yield path, path.stat()
+            except FileNotFoundError:
+                continue
+
+    def _discard(self, path: Path, size: int) -> None:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def _evict(self) -> None:
+        """Drop expired entries, then least-recently-used ones down to 90 % of
+        *max_bytes*. Caller must hold ``self._lock``."""
+        now     = time.time()
+        entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+        total   = sum(st.st_size for _, st in entries)
+        target  = int(self.max_bytes * 0.9)
+        for path, st in entries:
+            expired = self.max_age and now - st.st_mtime > self.max_age
+            if not expired and total <= target:
+                break
+            try:
+                path.unlink()
+                total -= st.st_size
+            except FileNotFoundError:
+                pass
+        self._size = total
 
+    def clear(self) -> None:
+        with self._lock:
+            for path, _ in self._entries():
+                path.unlink(missing_ok=True)
+            self._size = 0
 
-def _load_formats():
+
+ocr_cache: OcrCache | None = OcrCache(CACHE_DIR) if CACHE_ENABLED else None
+
+
+# ─── Chunk latency model ──────────────────────────────────────────────────
+# Used by the "adaptive" chunk strategy. Learns seconds ≈ overhead +
+# a·pages + b·MB from real uploads (cache hits are not observed) and
+# persists the exponentially weighted fit next to the OCR cache.
+CHUNK_STRATEGY = os.getenv("FRACTO_CHUNK_STRATEGY", "fixed")     # fixed | adaptive
+
+
+class LatencyModel:
+    """
+    Online least-squares fit of chunk upload time on (pages, megabytes).
+
+    Only exponentially weighted sufficient statistics are kept, so the model
+    tracks drift in Fracto's latency and stays a few hundred bytes on disk.
+    Until *min_samples* chunks have been observed the defaults are used.
+    """
+
+    DEFAULTS = (2.0, 1.0, 2.0)      # overhead s, s/page, s/MB
+
+    def __init__(self, path: Path, decay: float = 0.97, min_samples: int = 8):
+        self.path        = Path(path)
+        self.decay       = decay
+        self.min_samples = min_samples
+        self._lock       = threading.Lock()
+        self._loaded     = False
+        self.samples     = 0
+        self._xx = [[0.0] * 3 for _ in range(3)]
+        self._xy = [0.0] * 3
+        self.coef = self.DEFAULTS
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                state = json.load(fh)
+            self.samples, self._xx, self._xy = state["samples"], state["xx"], state["xy"]
+            self._refit()
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _refit(self) -> None:
+        if self.samples < self.min_samples:
+            self.coef = self.DEFAULTS
+            return
+        # 3×3 normal equations, tiny ridge for stability (Gauss-Jordan).
+        a = [row[:] + [self._xy[i]] for i, row in enumerate(self._xx)]
+        for i in range(3):
+            a[i][i] += 1e-6
+        for col in range(3):
+            piv = max(range(col, 3), key=lambda r: abs(a[r][col]))
+            if abs(a[piv][col]) < 1e-12:
+                self.coef = self.DEFAULTS
+                return
+            a[col], a[piv] = a[piv], a[col]
+            for r in range(3):
+                if r != col:
+                    f = a[r][col] / a[col][col]
+                    a[r] = [x - f * y for x, y in zip(a[r], a[col])]
+        coef = [a[i][3] / a[i][i] for i in range(3)]
+        # Negative slopes are noise – never let a page look free.
+        self.coef = (max(coef[0], 0.0), max(coef[1], 0.05), max(coef[2], 0.0))
+
+    def observe(self, pages: int, nbytes: int, seconds: float) -> None:
+        x = (1.0, float(pages), nbytes / 1_048_576)
+        with self._lock:
+            self._load()
+            d = self.decay
+            for i in range(3):
+                self._xy[i] = d * self._xy[i] + x[i] * seconds
+                for j in range(3):
+                    self._xx[i][j] = d * self._xx[i][j] + x[i] * x[j]
+            self.samples += 1
+            self._refit()
+            state = {"samples": self.samples, "xx": self._xx, "xy": self._xy}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                json.dump(state, fh)
+            os.replace(tmp, self.path)
+        except OSError as exc:
+            logger.warning("Could not persist latency model: %s", exc)
+
+    def page_cost(self, nbytes: int) -> float:
+        """Estimated marginal seconds for one page of *nbytes* encoded size."""
+        with self._lock:
+            self._load()
+            _, per_page, per_mb = self.coef
+        return per_page + per_mb * nbytes / 1_048_576
+
+
+latency_model = LatencyModel(CACHE_DIR / "latency.json")
+
+
+# ─── Pipeline metrics ─────────────────────────────────────────────────────
+# Stage timings, counters and latency histograms for the whole pipeline:
+#   parse   – PdfDocument(...) reading the upload
+#   prescan – reading every page's text layer (FRACTO_PRESCAN)
+#   split   – serializing one chunk (includes its stamping)
+#   stamp   – the share of `split` spent building stamped pages
+#   queue   – waiting for one of the engine's MAX_IN_FLIGHT upload slots
+#   upload  – one chunk POST incl. retries (also per page count, for tuning
+#             CHUNK_SIZE_PAGES)
+#   extract – projecting chunk results into an `OcrTable`
+#   excel   – writing the workbook
+#   export  – writing a CSV / JSON Lines / Parquet file
+#   document – plan → last chunk of one `aiter_fracto_parallel` run
+# Everything lands in the process-wide `metrics`, and additionally in the
+# `PipelineMetrics` bound by `collect_metrics` (every `Job` gets its own).
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                  5.0, 10.0, 25.0, 60.0, 120.0, 300.0, 600.0)   # seconds
+
+_METRIC_HELP = {
+    "stage_seconds":     "Wall time per pipeline stage.",
+    "chunk_seconds":     "Chunk upload time (incl. retries) by chunk page count.",
+    "documents_total":   "Documents run through the chunked OCR pipeline.",
+    "chunks_total":      "OCR chunks by outcome (ok, cached, error).",
+    "pages_total":       "Pages OCR'd successfully (uploaded or served from cache).",
+    "retries_total":     "Upload retries by reason (HTTP status or transport).",
+    "errors_total":      "Failures by pipeline stage.",
+    "pages_deduplicated_total": "Repeated pages not uploaded, by dedup policy.",
+    "pages_skipped_total": "Pages not uploaded after the pre-scan, by reason.",
+}
+
+
+class Histogram:
+    """Fixed-bucket latency histogram (Prometheus semantics, ``le`` bounds)."""
+
+    def __init__(self, bounds: tuple = METRIC_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)     # last slot: > bounds[-1]
+        self.count  = 0
+        self.sum    = 0.0
+        self.max    = 0.0
+
+    def observe(self, value: float) -> None:
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum   += value
+        self.max    = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimate the *q*-quantile by interpolating inside its bucket."""
+        if not self.count:
+            return 0.0
+        rank, seen, lo = q * self.count, 0, 0.0
+        for bound, n in zip(self.bounds, self.counts):
+            if n and seen + n >= rank:
+                return min(lo + (bound - lo) * (rank - seen) / n, self.max)
+            seen += n
+            lo = bound
+        return self.max
+
+    def stats(self) -> dict:
+        return {
+            "count":  self.count,
+            "total_s": round(self.sum, 4),
+            "mean_s": round(self.sum / self.count, 4) if self.count else 0.0,
+            "p50_s":  round(self.quantile(0.50), 4),
+            "p95_s":  round(self.quantile(0.95), 4),
+            "max_s":  round(self.max, 4),
+        }
+
+
+class PipelineMetrics:
+    """
+    Thread-safe counters and histograms keyed by (name, labels).
+
+    Export with `to_prometheus` (text exposition format, e.g. for the
+    node_exporter textfile collector) or `summary` (JSON-friendly dict
+    with the tuning knobs that were in effect).
+    """
+
+    def __init__(self):
+        self._lock     = threading.Lock()
+        self.started   = time.time()
+        self.counters: dict[tuple, float] = {}
+        self.histograms: dict[tuple, Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(seconds)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def to_prometheus(self, prefix: str = "fracto_") -> str:
+        def _labels(pairs) -> str:
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines: list[str] = []
+        with self._lock:
+            for name in sorted({n for n, _ in self.counters}):
+                lines += [f"# HELP {prefix}{name} {_METRIC_HELP.get(name, name)}",
+                          f"# TYPE {prefix}{name} counter"]
+                for (n, pairs), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{prefix}{name}{_labels(pairs)} {value:g}")
+            for name in sorted({n for n, _ in self.histograms}):
+                lines += [f"# HELP {prefix}{name} {_METRIC_HELP.get(name, name)}",
+                          f"# TYPE {prefix}{name} histogram"]
+                for (n, pairs), hist in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(hist.bounds + (float("inf"),), hist.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{prefix}{name}_bucket"
+                                     f"{_labels(pairs + (('le', le),))} {cumulative}")
+                    lines.append(f"{prefix}{name}_sum{_labels(pairs)} {hist.sum:.6f}")
+                    lines.append(f"{prefix}{name}_count{_labels(pairs)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """
+        ``{"config": …, "elapsed_s": …, "counters": …, "histograms": …}``.
+        Single-label series are keyed by the label value (``chunks_total →
+        {"ok": 7}``), unlabelled ones collapse to the bare number.
+        """
+        def _put(out: dict, name: str, pairs: tuple, value) -> None:
+            if not pairs:
+                out[name] = value
+                return
+            key = pairs[0][1] if len(pairs) == 1 else ",".join(f"{k}={v}" for k, v in pairs)
+            out.setdefault(name, {})[key] = value
+
+        counters: dict = {}
+        histograms: dict = {}
+        with self._lock:
+            for (name, pairs), value in sorted(self.counters.items()):
+                _put(counters, name, pairs, value)
+            for (name, pairs), hist in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+                _put(histograms, name, pairs, hist.stats())
+        return {
+            "config": {
+                "chunk_size_pages": CHUNK_SIZE_PAGES,
+                "chunk_strategy":   CHUNK_STRATEGY,
+                "max_parallel":     MAX_PARALLEL,
+                "max_in_flight":    MAX_IN_FLIGHT,
+                "cache":            ocr_cache is not None,
+            },
+            "elapsed_s":  round(time.time() - self.started, 3),
+            "counters":   counters,
+            "histograms": histograms,
+        }
+
+
+metrics = PipelineMetrics()
+_scoped_metrics: "contextvars.ContextVar[PipelineMetrics | None]" = \
+    contextvars.ContextVar("fracto_metrics", default=None)
+
+
+def write_metrics(path: str, source: PipelineMetrics | None = None) -> None:
+    """
+    Dump *source* (default: the process-wide `metrics`) to *path* – Prometheus
+    text for ``.prom`` / ``.txt``, otherwise the JSON `summary`.
+    """
+    source = source or metrics
+    if str(path).lower().endswith((".prom", ".txt")):
+        text = source.to_prometheus()
+    else:
+        text = json.dumps(source.summary(), indent=2)
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write(text)
+    logger.info("Metrics written to %s", path)
+
+
+@contextlib.contextmanager
+def collect_metrics(target: PipelineMetrics | None = None):
+    """
+    Also record everything the current thread/task triggers into *target*
+    (a fresh `PipelineMetrics` by default), which is yielded. The binding
+    follows the work onto the engine loop and `asyncio.to_thread` workers,
+    since both copy the caller's context.
+    """
+    target = target or PipelineMetrics()
+    token  = _scoped_metrics.set(target)
+    try:
+        yield target
+    finally:
+        _scoped_metrics.reset(token)
+
+
+def _count(name: str, value: float = 1, **labels) -> None:
+    metrics.inc(name, value, **labels)
+    scoped = _scoped_metrics.get()
+    if scoped is not None:
+        scoped.inc(name, value, **labels)
+
+
+def _observe(name: str, seconds: float, **labels) -> None:
+    metrics.observe(name, seconds, **labels)
+    scoped = _scoped_metrics.get()
+    if scoped is not None:
+        scoped.observe(name, seconds, **labels)
+
+
+@contextlib.contextmanager
+def _stage(stage: str):
+    """Time the block as *stage*; an exception escaping it counts as an error."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except BaseException as exc:
+        if not isinstance(exc, (GeneratorExit, asyncio.CancelledError)):
+            _count("errors_total", stage=stage)
+        raise
+    finally:
+        _observe("stage_seconds", time.perf_counter() - t0, stage=stage)
+
+
+def _load_formats(mapping_file: Path | None = None):
     """
     Parse mapping.yaml and return a dict[str, dict] keyed by human‑friendly
     format name → {'mappings':…, 'template_path':…, 'sheet_name':…}
@@ -177,13 +1355,14 @@ def _load_formats():
       ② multiple `excel_export_*` siblings
       ③ modern `formats: { … }`
     """
-    script_dir   = Path(__file__).parent
-    mapping_file = script_dir / "mapping.yaml"
+    mapping_file = Path(mapping_file or Path(__file__).parent / "mapping.yaml")
+    script_dir   = mapping_file.parent
     formats: dict[str, dict] = {}
 
     if not mapping_file.exists():
         return formats
 
+    import yaml
     with open(mapping_file, "r", encoding="utf-8") as f:
         data = yaml.safe_load(f) or {}
 
@@ -216,54 +1395,763 @@ def _load_formats():
 
     return formats
 
-FORMATS = _load_formats()
-DEFAULT_FORMAT = next(iter(FORMATS)) if FORMATS else "Customs Invoice"
 
-# Keep legacy single‑format globals for existing callers
-_default_cfg       = FORMATS.get(DEFAULT_FORMAT, {})
-MAPPINGS           = _default_cfg.get("mappings", {})
-TEMPLATE_PATH      = _default_cfg.get("template_path")
-SHEET_NAME         = _default_cfg.get("sheet_name")
-HEADERS = list(MAPPINGS.keys())
+# ─── Format registry ─────────────────────────────────────────────────────
+def _file_stamp(path) -> tuple | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
 
 
-def call_fracto(file_bytes: bytes, file_name: str) -> Dict[str, Any]:
+def _compile_projector(fields: tuple):
+    """Row dict → tuple of *fields* ('' when missing), bound once per format."""
+    def project(row: dict) -> tuple:
+        get = row.get
+        return tuple([get(f, "") for f in fields])
+    return project
+
+
+class FormatSpec:
     """
-    Send the whole PDF to Fracto OCR and return the JSON response.
+    One output format from mapping.yaml with its header → field mapping
+    compiled into row projectors, so building a table is one call per row
+    instead of re-resolving every mapping for every cell.
     """
-    files = {
-        "file": (file_name, io.BytesIO(file_bytes), "application/pdf"),
-    }
+
+    def __init__(self, name: str, cfg: dict):
+        self.name          = name
+        self.cfg           = cfg
+        self.mappings      = cfg.get("mappings") or {}
+        self.template_path = cfg.get("template_path") or None
+        self.sheet_name    = cfg.get("sheet_name")
+        self.headers       = list(self.mappings.keys())
+        self.fields        = {h: self.mappings.get(h, h) for h in self.headers}
+        self._projectors: dict[frozenset, tuple] = {}
+
+    def projector(self, constant: frozenset = frozenset()):
+        """(projected headers, projector) for everything not in *constant*."""
+        hit = self._projectors.get(constant)
+        if hit is None:
+            projected = [h for h in self.headers if h not in constant]
+            hit = (projected, _compile_projector(tuple(self.fields[h] for h in projected)))
+            self._projectors[constant] = hit
+        return hit
+
+    def table(self, results: List[Dict[str, Any]],
+              overrides: dict[str, str] | None = None) -> "OcrTable":
+        """
+        Project *results* into an `OcrTable`; *overrides* become constant
+        columns. Serials are renumbered on the table (`OcrTable.renumber`),
+        so it is correct whether or not the result dicts were.
+        """
+        overrides = {k: v for k, v in (overrides or {}).items() if k in self.fields}
+        projected, project = self.projector(frozenset(overrides))
+        with _stage("extract"):
+            tuples = [project(row)
+                      for result in results
+                      for row in _extract_rows(result.get("data", []))]
+        n = len(tuples)
+        columns = {h: list(col) for h, col in zip(projected, zip(*tuples))}
+        for h in projected:
+            columns.setdefault(h, [])
+        for h, v in overrides.items():
+            columns[h] = [v] * n
+        fields = {h: f for h, f in self.fields.items() if h not in overrides}   # constants
+        table  = OcrTable(self.headers, {h: columns[h] for h in self.headers}, fields)
+        table.renumber()
+        return table
+
+
+class FormatRegistry:
+    """
+    Live, compiled view of mapping.yaml.
+
+    Every lookup stats the mapping file; when its (mtime, size) stamp moves
+    the file is re-hashed and – only if the content really changed –
+    re-parsed and re-compiled.  Templates need no watching here:
+    `template_cache` already re-validates them on each use.  This replaces
+    re-importing the module to pick up edits, which also threw away the
+    HTTP client, caches and latency model on every Streamlit rerun.
+    """
+
+    def __init__(self, mapping_file: Path):
+        self.mapping_file = Path(mapping_file)
+        self._lock    = threading.Lock()
+        self._stamp   = False          # never a valid stamp → first lookup loads
+        self._digest  = None
+        self._formats: dict[str, dict] = {}
+        self._specs:   dict[str, FormatSpec] = {}
+
+    def _refresh(self) -> None:
+        stamp = _file_stamp(self.mapping_file)
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            try:
+                raw = self.mapping_file.read_bytes()
+            except OSError:
+                raw = b""
+            digest = hashlib.sha256(raw).hexdigest()
+            if digest != self._digest:
+                if self._digest is not None:
+                    logger.info("Reloading formats from %s", self.mapping_file)
+                formats = _load_formats(self.mapping_file)
+                self._specs   = {n: FormatSpec(n, c) for n, c in formats.items()}
+                self._formats = formats
+                self._digest  = digest
+            self._stamp = stamp
+
+    def formats(self) -> dict[str, dict]:
+        """name → raw config, the shape `FORMATS` always had."""
+        self._refresh()
+        return self._formats
+
+    def names(self) -> list[str]:
+        return list(self.formats())
+
+    @property
+    def default(self) -> str:
+        return next(iter(self.formats()), "Customs Invoice")
+
+    def get(self, name: str | None = None) -> FormatSpec:
+        """Compiled spec for *name* (the default format when omitted)."""
+        self._refresh()
+        specs = self._specs
+        name = name or next(iter(specs), "Customs Invoice")
+        if name in specs:
+            return specs[name]
+        if not specs:                  # no mapping.yaml – empty format, like FORMATS.get(…, {})
+            return FormatSpec(name, {})
+        raise KeyError(f"Unknown format {name!r} (choose from: {', '.join(specs)})")
+
+
+format_registry = FormatRegistry(Path(__file__).parent / "mapping.yaml")
+
+# Legacy module globals (FORMATS, MAPPINGS, …) resolve through the registry
+# on access instead of parsing mapping.yaml at import time.
+_LEGACY_FORMAT_ATTRS = {
+    "FORMATS":        lambda: format_registry.formats(),
+    "DEFAULT_FORMAT": lambda: format_registry.default,
+    "MAPPINGS":       lambda: format_registry.get().mappings,
+    "TEMPLATE_PATH":  lambda: format_registry.get().template_path,
+    "SHEET_NAME":     lambda: format_registry.get().sheet_name,
+    "HEADERS":        lambda: format_registry.get().headers,
+}
+
+
+def __getattr__(name: str):
+    if name in _LEGACY_FORMAT_ATTRS:
+        return _LEGACY_FORMAT_ATTRS[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# ─── Async OCR engine ────────────────────────────────────────────────────
+class _Engine:
+    """
+    One background event loop shared by every caller in the process.
+
+    It owns the pooled ``httpx.AsyncClient`` and a global semaphore capped at
+    MAX_IN_FLIGHT, so chunk uploads from many PDFs (Streamlit sessions, batch
+    jobs, async callers) share a single concurrency budget and a single set
+    of keep-alive connections instead of one thread pool per document.
+    """
+
+    def __init__(self):
+        self._lock   = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self.client: "httpx.AsyncClient | None" = None
+        self.slots: asyncio.Semaphore | None = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    self._start()
+        return self._loop
+
+    def _start(self) -> None:
+        loop  = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def _run():
+            import httpx
+            asyncio.set_event_loop(loop)
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=MAX_IN_FLIGHT,
+                                    max_keepalive_connections=MAX_IN_FLIGHT),
+            )
+            self.slots = asyncio.Semaphore(MAX_IN_FLIGHT)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        self._thread = threading.Thread(target=_run, name="fracto-engine", daemon=True)
+        self._thread.start()
+        ready.wait()
+        self._loop = loop
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Schedule *coro* on the engine loop from any thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """Block the calling (non-engine) thread until *coro* finishes."""
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("blocking engine call from inside the engine loop")
+        return self.submit(coro).result()
+
+    async def run_async(self, coro):
+        """Await *coro* on the engine loop from whichever loop we are in."""
+        if asyncio.get_running_loop() is self.loop:
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro))
+
+
+_engine = _Engine()
+
+
+# ─── OCR transports ──────────────────────────────────────────────────────
+# `transport.post` is the only place a chunk leaves the process, so swapping
+# it changes where OCR answers come from without touching the pipeline:
+#   http   – live uploads to FRACTO_ENDPOINT (default)
+#   record – live uploads, every attempt (status, body, headers, timing)
+#            also stored under FRACTO_RECORD_DIR by request fingerprint
+#   replay – no network: recorded attempts are served back in order, with
+#            the original timing reproduced when FRACTO_REPLAY_SPEED > 0
+#            (1 = real time, 2 = twice as fast)
+# The fingerprint is `OcrCache.key`, i.e. chunk bytes + parser settings.
+TRANSPORT_MODE = os.getenv("FRACTO_TRANSPORT", "http")             # http | record | replay
+RECORD_DIR     = Path(os.getenv("FRACTO_RECORD_DIR", str(CACHE_DIR / "recordings"))).expanduser()
+REPLAY_SPEED   = float(os.getenv("FRACTO_REPLAY_SPEED", "0"))
+_RECORDED_HEADERS = ("content-type", "retry-after")
+
+
+class HttpTransport:
+    """Live uploads through the engine's pooled ``httpx.AsyncClient``."""
+
+    live      = True      # real latencies: may train `latency_model`
+    use_cache = True      # `ocr_cache` may answer before the transport
+
+    def pace(self, delay: float) -> float:
+        """Retry backoff actually slept for a *delay* computed by `_backoff_delay`."""
+        return delay
+
+    async def post(self, file_bytes: bytes, file_name: str,
+                   data: dict, headers: dict) -> "httpx.Response":
+        return await _engine.client.post(
+            FRACTO_ENDPOINT,
+            headers=headers,
+            files={"file": (file_name, _upload_body(file_bytes), "application/pdf")},
+            data=data,
+        )
+
+
+def _recording_path(root: Path, key: str) -> Path:
+    return root / key[:2] / f"{key}.json"
+
+
+class RecordingTransport:
+    """
+    Wrap *inner* (live HTTP by default) and store every attempt.
+
+    One JSON file per fingerprint holds the attempts of the latest run in
+    order – retried 503s and transport errors included – so a replay walks
+    the same retry path. The OCR cache is bypassed while recording,
+    otherwise cache hits would never reach the transport.
+    """
+
+    live      = True
+    use_cache = False
+
+    def __init__(self, root: Path = RECORD_DIR, inner=None):
+        self.root  = Path(root)
+        self.inner = inner or HttpTransport()
+        self._lock = threading.Lock()
+        self._seen: set[str] = set()      # fingerprints (re)started this run
+
+    def pace(self, delay: float) -> float:
+        return self.inner.pace(delay)
+
+    def _save(self, key: str, file_name: str, size: int, attempt: dict) -> None:
+        path = _recording_path(self.root, key)
+        with self._lock:
+            entry = None
+            if key in self._seen:
+                try:
+                    with open(path, "r", encoding="utf-8") as fh:
+                        entry = json.load(fh)
+                except (OSError, ValueError):
+                    pass
+            self._seen.add(key)
+            if entry is None:
+                entry = {"fingerprint": key, "file": file_name, "bytes": size,
+                         "parser": [PARSER_APP_ID, MODEL_ID, EXTRA_ACCURACY],
+                         "recorded": time.time(), "attempts": []}
+            entry["attempts"].append(attempt)
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+                with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                    json.dump(entry, fh)
+                os.replace(tmp, path)
+            except OSError as exc:
+                logger.warning("Could not record %s: %s", file_name, exc)
+
+    async def post(self, file_bytes: bytes, file_name: str,
+                   data: dict, headers: dict) -> "httpx.Response":
+        import base64
+        import httpx
+
+        key   = OcrCache.key(file_bytes)
+        start = time.perf_counter()
+        try:
+            resp = await self.inner.post(file_bytes, file_name, data, headers)
+        except httpx.TransportError as exc:
+            attempt = {"error": repr(exc), "elapsed": time.perf_counter() - start}
+            await asyncio.to_thread(self._save, key, file_name, len(file_bytes), attempt)
+            raise
+        attempt = {
+            "status":  resp.status_code,
+            "headers": {h: resp.headers[h] for h in _RECORDED_HEADERS if h in resp.headers},
+            "elapsed": time.perf_counter() - start,
+        }
+        try:
+            attempt["body"] = resp.content.decode("utf-8")
+        except UnicodeDecodeError:
+            attempt["body_b64"] = base64.b64encode(resp.content).decode("ascii")
+        await asyncio.to_thread(self._save, key, file_name, len(file_bytes), attempt)
+        return resp
+
+
+class ReplayTransport:
+    """
+    Serve recorded attempts back without touching the network.
+
+    Each fingerprint's attempts are replayed in order (the last one repeats
+    once they run out), so a document replays the same way every time.
+    With *speed* > 0 each answer – and each retry backoff, including a
+    recorded Retry-After – is delayed by its duration ÷ *speed*; at 0 both
+    are skipped. A chunk that was never recorded fails with `LookupError`.
+    """
+
+    live      = False     # replayed timings must not train `latency_model`
+    use_cache = True
+
+    def __init__(self, root: Path = RECORD_DIR, speed: float = REPLAY_SPEED):
+        self.root    = Path(root)
+        self.speed   = speed
+        self._lock   = threading.Lock()
+        self._cursor: dict[str, int] = {}
+
+    def pace(self, delay: float) -> float:
+        return delay / self.speed if self.speed > 0 else 0.0
+
+    def _load(self, key: str) -> dict | None:
+        try:
+            with open(_recording_path(self.root, key), "r", encoding="utf-8") as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+
+    async def post(self, file_bytes: bytes, file_name: str,
+                   data: dict, headers: dict) -> "httpx.Response":
+        import base64
+        import httpx
+
+        key   = OcrCache.key(file_bytes)
+        entry = await asyncio.to_thread(self._load, key)
+        if not entry or not entry.get("attempts"):
+            raise LookupError(f"no recording of {file_name} ({key[:12]}…) in {self.root}")
+        with self._lock:
+            n = self._cursor.get(key, 0)
+            self._cursor[key] = n + 1
+        attempt = entry["attempts"][min(n, len(entry["attempts"]) - 1)]
+        if self.speed > 0:
+            await asyncio.sleep(attempt.get("elapsed", 0.0) / self.speed)
+        if "error" in attempt:
+            raise httpx.TransportError(f"replayed: {attempt['error']}")
+        if "body_b64" in attempt:
+            content = base64.b64decode(attempt["body_b64"])
+        else:
+            content = attempt.get("body", "").encode("utf-8")
+        return httpx.Response(
+            attempt["status"],
+            headers=attempt.get("headers") or {},
+            content=content,
+            request=httpx.Request("POST", FRACTO_ENDPOINT),
+        )
+
+
+def make_transport(mode: str = TRANSPORT_MODE, root: Path | None = None,
+                   speed: float = REPLAY_SPEED):
+    """Build the transport for *mode* (``http`` / ``record`` / ``replay``)."""
+    root = Path(root).expanduser() if root else RECORD_DIR
+    if mode == "http":
+        return HttpTransport()
+    if mode == "record":
+        return RecordingTransport(root)
+    if mode == "replay":
+        return ReplayTransport(root, speed)
+    raise ValueError(f"unknown transport {mode!r} (expected http, record or replay)")
+
+
+transport = make_transport()
+
+
+def _backoff_delay(attempt: int, retry_after: str | None = None) -> float:
+    """Exponential backoff with full jitter; honours a numeric Retry-After."""
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+async def _post_with_retries(file_bytes: bytes, file_name: str,
+                             data: dict, headers: dict) -> "tuple[httpx.Response, float]":
+    """
+    POST one chunk via `transport`, retrying transport errors, timeouts and RETRY_STATUSES
+    up to MAX_RETRIES times. OCR uploads are side-effect free on the Fracto
+    side, so replaying them is safe. Must run on the engine loop.
+
+    Returns the response and the seconds its own attempt took (no failed
+    attempts or backoff sleeps), which is what `latency_model` learns from.
+    """
+    import httpx
+    for attempt in range(MAX_RETRIES + 1):
+        last = attempt == MAX_RETRIES
+        sent = time.perf_counter()
+        try:
+            resp = await transport.post(file_bytes, file_name, data, headers)
+        except httpx.TransportError as exc:
+            if last:
+                raise
+            delay = transport.pace(_backoff_delay(attempt))
+            _count("retries_total", reason="transport")
+            logger.warning("↻ %s: %r – retrying in %.1fs", file_name, exc, delay)
+        else:
+            if resp.status_code not in RETRY_STATUSES or last:
+                resp.raise_for_status()
+                return resp, time.perf_counter() - sent
+            delay = transport.pace(_backoff_delay(attempt, resp.headers.get("Retry-After")))
+            _count("retries_total", reason=str(resp.status_code))
+            logger.warning("↻ %s: HTTP %d – retrying in %.1fs",
+                           file_name, resp.status_code, delay)
+        await asyncio.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+async def _ocr_chunk(file_bytes: bytes, file_name: str,
+                     pages: int | None = None) -> Dict[str, Any]:
+    """Engine-side body of `acall_fracto` (cache → upload → cache)."""
+    cache_key = OcrCache.key(file_bytes) if ocr_cache and transport.use_cache else None
+    if cache_key:
+        cached = await asyncio.to_thread(ocr_cache.get, cache_key)
+        if cached is not None:
+            logger.info("✓ %s served from cache", file_name)
+            _count("chunks_total", status="cached")
+            _count("pages_total", pages or 0)
+            return {"file": file_name, "status": "ok", "data": cached}
+
     data = {
         "parserApp": PARSER_APP_ID,
         "model": MODEL_ID,
         "extra_accuracy": EXTRA_ACCURACY,
     }
     # Prepare headers; require API key for production endpoint
-    if not API_KEY:
+    # Read per call: the Streamlit app exports the secret after import
+    api_key = os.getenv("FRACTO_API_KEY") or API_KEY
+    if not api_key and transport.live:
         raise RuntimeError(
             "FRACTO_API_KEY is not set. Add it to your environment or Streamlit secrets."
         )
-    headers = {"x-api-key": API_KEY}
+    headers = {"x-api-key": api_key or ""}
 
     try:
-        start = time.time()
-        resp = requests.post(
-            FRACTO_ENDPOINT,
-            headers=headers,
-            files=files,
-            data=data,
-            timeout=600,         # seconds
-        )
-        resp.raise_for_status()
-        elapsed = time.time() - start
+        queued = time.perf_counter()
+        async with _engine.slots:
+            _observe("stage_seconds", time.perf_counter() - queued, stage="queue")
+            start = time.time()
+            try:
+                resp, attempt = await _post_with_retries(file_bytes, file_name, data, headers)
+            finally:
+                elapsed = time.time() - start
+                _observe("stage_seconds", elapsed, stage="upload")
         logger.info("✓ %s processed in %.2fs", file_name, elapsed)
-        return {"file": file_name, "status": "ok", "data": resp.json()}
+        _observe("chunk_seconds", elapsed, pages=pages or "?")
+        _count("chunks_total", status="ok")
+        _count("pages_total", pages or 0)
+        payload = resp.json()
+        if cache_key:
+            await asyncio.to_thread(ocr_cache.put, cache_key, payload)
+        if pages and transport.live:
+            await asyncio.to_thread(latency_model.observe, pages, len(file_bytes), attempt)
+        return {"file": file_name, "status": "ok", "data": payload}
     except Exception as exc:
         logger.error("✗ %s failed: %s", file_name, exc)
+        _count("chunks_total", status="error")
+        _count("errors_total", stage="upload")
         return {"file": file_name, "status": "error", "error": str(exc)}
 
 
+async def acall_fracto(file_bytes: bytes, file_name: str,
+                       *, pages: int | None = None) -> Dict[str, Any]:
+    """
+    Async counterpart of `call_fracto`. Safe to await from any event loop;
+    the upload itself always runs on the shared engine. Passing the chunk's
+    *pages* lets the upload time train `latency_model`.
+    """
+    return await _engine.run_async(_ocr_chunk(file_bytes, file_name, pages))
+
+
+def call_fracto(file_bytes: bytes, file_name: str) -> Dict[str, Any]:
+    """
+    Send the whole PDF to Fracto OCR and return the JSON response.
+
+    Responses are memoised in `ocr_cache`, so re-processing identical bytes
+    with the same parser settings costs no API call.
+    """
+    return _engine.run(_ocr_chunk(file_bytes, file_name))
+
+
+
+# ─── Parallel chunked OCR ───────────────────────────────────────────────
+def _tag_chunk(result: dict, idx: int, pages: "range | list[int]", chunk: "bytes | ChunkFile | None",
+               job_no: str | None) -> dict:
+    """
+    Record where a chunk came from so `resume_results` can later rebuild and
+    re-submit exactly that chunk: 1-based index, 1-based inclusive page span,
+    SHA-256 of the uploaded bytes and the job number it was stamped with,
+    plus any blank pages inside the span that were not uploaded.
+    """
+    result["chunk"]  = idx + 1
+    result["pages"]  = [pages[0] + 1, pages[-1] + 1]
+    if len(pages) != pages[-1] - pages[0] + 1:    # blank pages left out (see `plan_chunks`)
+        kept = set(pages)
+        result["skipped_pages"] = [p + 1 for p in range(pages[0], pages[-1]) if p not in kept]
+    if chunk is not None:                  # None: skipped page, nothing uploaded
+        result["sha256"] = _sha256(chunk)
+    if job_no:
+        result["job_no"] = job_no
+    return result
+
+async def aiter_fracto_parallel(pdf: "bytes | PdfDocument", file_name: str, *,
+                                ordered: bool = False, on_chunk=None,
+                                json_field: str = "Serial_Number"):
+    """
+    Stream chunk results while the rest of the document is still in flight.
+
+    With ``ordered=False`` results are yielded as chunks complete; with
+    ``ordered=True`` chunk *k* is yielded as soon as chunks 1…k are all done.
+    Serial numbers (*json_field*) are assigned incrementally: whenever the
+    run of finished chunks starting at chunk 1 grows, its new rows continue
+    the numbering. Ordered results therefore always carry final serials; an
+    out-of-order result keeps the API's numbering until every earlier chunk
+    has finished and is then renumbered in place (the same dict).
+
+    Chunking, per-document pipelining and *on_chunk* behave exactly like
+    `acall_fracto_parallel`. Closing the iterator early cancels the uploads
+    that are still running. With a DEDUP_POLICY (see `plan_chunks`) repeated
+    pages are yielded as placeholder results carrying ``duplicate_of``; with
+    PRESCAN, skipped blank pages as empty results marked ``skipped``.
+    """
+    started = time.perf_counter()
+    doc    = pdf if isinstance(pdf, PdfDocument) else await asyncio.to_thread(PdfDocument, pdf)
+    policy = DEDUP_POLICY
+    recent = recent_pages if policy != "off" and recent_pages.capacity > 0 else None
+    if policy == "off" and not PRESCAN:
+        ranges = await asyncio.to_thread(doc.chunk_ranges, CHUNK_SIZE_PAGES, MIN_TAIL_COMBINE)
+        skips, fps = {}, []
+    else:
+        ranges, skips, fps = await asyncio.to_thread(
+            plan_chunks, doc, policy, PRESCAN, CHUNK_SIZE_PAGES, MIN_TAIL_COMBINE, recent)
+    dupes  = {i: s for i, s in skips.items() if "blank" not in s}
+    upload = [i for i in range(len(ranges)) if i not in skips]
+    chunks = doc.iter_chunks([ranges[i] for i in upload])
+    total  = len(ranges)
+    done   = 0
+
+    def _report(result: dict | None) -> None:
+        if on_chunk is not None:
+            try:
+                on_chunk(result, done, total)
+            except Exception:
+                logger.exception("on_chunk callback failed")
+
+    _report(None)
+    if total > 1:
+        logger.info("Splitting %s into %d chunks (%s pages, %s strategy)", file_name,
+                    total, ",".join(str(len(r)) for r in ranges), CHUNK_STRATEGY)
+    if policy != "off":
+        from_recent = sum("recent" in d for d in dupes.values())
+        logger.info("Dedup (%s) %s: %d of %d page(s) are repeats (%d within the document, "
+                    "%d from recent documents) – uploading %d page(s)",
+                    policy, file_name, len(dupes), doc.page_count, len(dupes) - from_recent,
+                    from_recent, doc.page_count - len(dupes))
+        if dupes:
+            _count("pages_deduplicated_total", len(dupes), policy=policy)
+    if PRESCAN:
+        blanks = (sum(s.get("blank", 0) for s in skips.values())
+                  + sum(r[-1] - r[0] + 1 - len(r) for r in ranges))
+        logger.info("Pre-scan %s: %d blank page(s) skipped", file_name, blanks)
+        if blanks:
+            _count("pages_skipped_total", blanks, reason="blank")
+
+    # Pipeline: serialize the next chunk only once a per-document slot is
+    # free, so OCR of chunk 1 overlaps with writing chunks 2..N and at most
+    # MAX_PARALLEL chunk buffers are alive at any time.
+    per_doc  = asyncio.Semaphore(MAX_PARALLEL)
+    finished: asyncio.Queue = asyncio.Queue()
+    tasks: list[asyncio.Task] = []
+    waiting: dict[int, list[int]] = {}          # first-copy slot → repeat slots
+    for idx, skip in skips.items():
+        if "slot" in skip:
+            waiting.setdefault(skip["slot"], []).append(idx)
+        else:
+            result = (_blank_result(file_name) if "blank" in skip
+                      else _duplicate_result(file_name, policy, skip))
+            finished.put_nowait((idx, _tag_chunk(result, idx, ranges[idx], None, doc.job_no)))
+
+    async def _one(idx: int, chunk: "bytes | ChunkFile") -> None:
+        name = file_name if total == 1 else f"{file_name} (part {idx+1})"
+        try:
+            try:
+                result = await acall_fracto(chunk, name, pages=len(ranges[idx]))
+            except Exception as exc:
+                logger.error("Chunk %d failed: %s", idx + 1, exc)
+                _count("chunks_total", status="error")
+                _count("errors_total", stage="upload")
+                result = {"file": file_name, "status": "error", "error": str(exc)}
+            finally:
+                per_doc.release()
+            finished.put_nowait((idx, _tag_chunk(result, idx, ranges[idx], chunk, doc.job_no)))
+            for rep_idx in waiting.pop(idx, ()):
+                copy = _duplicate_result(file_name, policy, dupes[rep_idx], result)
+                finished.put_nowait((rep_idx, _tag_chunk(copy, rep_idx, ranges[rep_idx],
+                                                         None, doc.job_no)))
+            if recent is not None and result.get("status") == "ok":
+                single = len(ranges[idx]) == 1
+                for page in ranges[idx]:
+                    recent.remember(fps[page], f"{file_name} p.{page + 1}",
+                                    result.get("data") if single else None)
+        finally:
+            if isinstance(chunk, ChunkFile):
+                chunk.close()
+
+    async def _feed() -> None:
+        try:
+            for idx in upload:
+                await per_doc.acquire()
+                try:
+                    chunk = await asyncio.to_thread(next, chunks)
+                except BaseException:
+                    per_doc.release()
+                    raise
+                tasks.append(asyncio.create_task(_one(idx, chunk)))
+        except Exception as exc:
+            finished.put_nowait((None, exc))
+
+    feeder  = asyncio.create_task(_feed())
+    pending: dict[int, dict] = {}
+    prefix, serial = 0, 1
+    try:
+        while done < total:
+            idx, result = await finished.get()
+            if idx is None:
+                raise result
+            done += 1
+            _report(result)
+            pending[idx] = result
+            ready = []
+            while prefix in pending:               # contiguous prefix grew
+                head = pending.pop(prefix)
+                serial = _renumber_from(head, serial, json_field)
+                ready.append(head)
+                prefix += 1
+            if ordered:
+                for head in ready:
+                    yield head
+            else:
+                yield result
+        _count("documents_total")
+        _observe("stage_seconds", time.perf_counter() - started, stage="document")
+    finally:
+        feeder.cancel()
+        for t in tasks:
+            t.cancel()
+
+
+async def acall_fracto_parallel(pdf: "bytes | PdfDocument", file_name: str, *,
+                                on_chunk=None) -> list[dict]:
+    """
+    Async counterpart of `call_fracto_parallel`. Chunks are uploaded through
+    the shared engine, so awaiting this for several PDFs at once interleaves
+    their chunks under one global MAX_IN_FLIGHT budget (and at most
+    MAX_PARALLEL per document).
+
+    *on_chunk(result, done, total)* is called once with ``(None, 0, total)``
+    when the chunk plan is known and then as each chunk finishes (in
+    completion order, before serial renumbering). It runs on the engine
+    loop, so it must be quick; exceptions it raises are logged and ignored.
+    """
+    return [r async for r in aiter_fracto_parallel(pdf, file_name, ordered=True,
+                                                   on_chunk=on_chunk)]
+
+def call_fracto_parallel(pdf: "bytes | PdfDocument", file_name: str, *,
+                         on_chunk=None) -> list[dict]:
+    """
+    If the PDF is ≤ chunk_size_pages, behaves like `call_fracto` (returns [single‑result]).
+    If more, splits into chunk_size_pages page chunks and hits the Fracto API concurrently with
+    up to `MAX_PARALLEL` workers. Results are returned in order of the chunks.
+
+    *pdf* may be raw bytes or a `PdfDocument` that was already parsed (and
+    possibly stamped) by the caller. *on_chunk* reports per-chunk progress,
+    see `acall_fracto_parallel`.
+    """
+    return _engine.run(acall_fracto_parallel(pdf, file_name, on_chunk=on_chunk))
+
+def iter_fracto_parallel(pdf: "bytes | PdfDocument", file_name: str, *,
+                         ordered: bool = False, on_chunk=None) -> "Iterator[dict]":
+    """
+    Blocking generator over `aiter_fracto_parallel` for synchronous callers:
+    chunk results arrive while later chunks are still uploading, e.g. ::
+
+        for result in iter_fracto_parallel(pdf_bytes, "inv.pdf", ordered=True):
+            rows.extend(_extract_rows(result.get("data", [])))
+
+    Leaving the loop early cancels the remaining uploads.
+    """
+    import queue
+
+    q: "queue.Queue" = queue.Queue()
+    end = object()
+
+    async def _pump() -> None:
+        try:
+            async for result in aiter_fracto_parallel(pdf, file_name, ordered=ordered,
+                                                      on_chunk=on_chunk):
+                q.put(result)
+        except Exception as exc:
+            q.put(exc)
+        finally:
+            q.put(end)
+
+    future = _engine.submit(_pump())
+    try:
+        while (item := q.get()) is not end:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        future.cancel()
 
 
 # ─── Helper to persist results ───────────────────────────────────────────
@@ -272,7 +2160,8 @@ def save_results(results: List[Dict[str, Any]], pdf_path: str, out_path: str | N
     Persist OCR results to disk.
 
     If *out_path* is None, a file named "<original‑stem>_ocr.json" is created
-    alongside the input PDF.
+    alongside the input PDF. Chunk results carry their page span and hash
+    (see `_tag_chunk`), so the file can later be fed to ``--resume``.
 
     Returns the absolute path to the saved file.
     """
@@ -285,24 +2174,594 @@ def save_results(results: List[Dict[str, Any]], pdf_path: str, out_path: str | N
     return str(out_path)
 
 
+# ─── Resume failed chunks ────────────────────────────────────────────────
+async def aresume_results(results: list[dict], pdf_path: str) -> list[dict]:
+    """
+    Re-submit only the chunks of *results* whose status is not "ok".
+
+    Each failed chunk is rebuilt from *pdf_path* using the page span and job
+    number recorded by `_tag_chunk`, checked against its saved SHA-256 (so a
+    different or edited PDF is rejected), uploaded again and swapped in
+    place. Serial numbers are then renumbered across the whole document.
+    """
+    failed = [i for i, r in enumerate(results) if r.get("status") != "ok"]
+    if not failed:
+        logger.info("Nothing to resume – all %d chunk(s) are ok", len(results))
+        return results
+    missing = [results[i].get("chunk", i + 1) for i in failed if "pages" not in results[i]]
+    if missing:
+        raise ValueError(
+            f"chunk(s) {missing} have no page span recorded; re-process the PDF in full"
+        )
+
+    doc  = await asyncio.to_thread(PdfDocument, Path(pdf_path))
+    job_no = next((r["job_no"] for r in results if r.get("job_no")), None)
+    if job_no:
+        await asyncio.to_thread(doc.stamp_job_number, job_no)
+
+    name = Path(pdf_path).name
+    logger.info("Resuming %s: re-submitting %d of %d chunk(s)", name, len(failed), len(results))
+
+    # PdfDocument is not thread-safe: chunks are serialized one at a time and
+    # only the uploads overlap, at most MAX_PARALLEL chunk buffers alive.
+    write_lock = asyncio.Lock()
+    per_doc    = asyncio.Semaphore(MAX_PARALLEL)
+
+    async def _one(idx: int) -> None:
+        old   = results[idx]
+        first, last = old["pages"]
+        skipped = set(old.get("skipped_pages", ()))
+        pages = _page_run([p - 1 for p in range(first, last + 1) if p not in skipped])
+        if last > doc.page_count:
+            raise ValueError(f"{name} has {doc.page_count} pages; chunk {idx + 1} needs {last}")
+        async with per_doc:
+            async with write_lock:
+                chunk = await asyncio.to_thread(doc.chunk_bytes, pages)
+            try:
+                if old.get("sha256") and _sha256(chunk) != old["sha256"]:
+                    raise ValueError(f"chunk {idx + 1} of {name} does not match the saved hash")
+                label  = name if len(results) == 1 else f"{name} (part {idx + 1})"
+                result = await acall_fracto(chunk, label, pages=len(pages))
+                results[idx] = _tag_chunk(result, idx, pages, chunk, job_no)
+            finally:
+                if isinstance(chunk, ChunkFile):
+                    chunk.close()
+
+    try:
+        await asyncio.gather(*(_one(i) for i in failed))
+    finally:
+        doc.close()
+    _renumber_serials(results)
+    still = sum(r.get("status") != "ok" for r in results)
+    logger.info("Resume finished: %d chunk(s) still failing", still)
+    return results
+
+
+def resume_results(results: list[dict], pdf_path: str) -> list[dict]:
+    """Blocking wrapper around `aresume_results`."""
+    return _engine.run(aresume_results(results, pdf_path))
+
+
+def _resume_cli(args: list[str]) -> None:
+    """
+    python -m mcc --resume <results.json> <pdf-path> [output.xlsx|.csv|.jsonl|.parquet]
+                  [--format NAME] [KEY=VALUE ...]
+    """
+    positional, overrides, format_name = [], {}, None
+    it = iter(args)
+    for arg in it:
+        if arg == "--format":
+            format_name = next(it, None)
+        elif "=" in arg and not Path(arg).exists():
+            k, v = arg.split("=", 1)
+            overrides[k.strip()] = v
+        else:
+            positional.append(arg)
+    if len(positional) < 2:
+        print("Usage: python -m mcc --resume <results.json> <pdf-path> "
+              "[output.xlsx|.csv|.jsonl|.parquet] [--format NAME] [KEY=VALUE ...]")
+        sys.exit(1)
+
+    json_path, pdf_path = positional[0], positional[1]
+    p = Path(pdf_path).expanduser()
+    excel_out = positional[2] if len(positional) > 2 else str(p.with_name(f"{p.stem}_ocr.xlsx"))
+    try:
+        spec = format_registry.get(format_name)
+    except KeyError as exc:
+        logger.error("%s", exc.args[0])
+        sys.exit(1)
+
+    with open(json_path, "r", encoding="utf-8") as fh:
+        results = json.load(fh)
+    results = resume_results(results, pdf_path)
+    save_results(results, pdf_path, json_path)
+    export_ocr(
+        results, excel_out, overrides,
+        kind=export_kind(excel_out) or "xlsx",
+        mappings=spec,
+        template_path=spec.template_path,
+        sheet_name=spec.sheet_name,
+    )
+    sys.exit(1 if any(r.get("status") != "ok" for r in results) else 0)
+
+
+# ─── Single-file & batch processing ──────────────────────────────────────
+BATCH_MAX_DOCS = int(os.getenv("FRACTO_BATCH_MAX_DOCS", "6"))   # PDFs split/held at once
+
+
+async def aprocess_pdf(pdf_path: str, job_no: str | None = None) -> list[dict]:
+    """Open *pdf_path*, optionally stamp it, and OCR it through the engine."""
+    doc = await asyncio.to_thread(PdfDocument, Path(pdf_path))
+    try:
+        if job_no:
+            await asyncio.to_thread(doc.stamp_job_number, job_no)
+        return await acall_fracto_parallel(doc, Path(pdf_path).name)
+    finally:
+        doc.close()
+
+
+def process_pdf(pdf_path: str, job_no: str | None = None) -> list[dict]:
+    """Blocking wrapper around `aprocess_pdf`."""
+    return _engine.run(aprocess_pdf(pdf_path, job_no))
+
+
+def _collect_pdfs(specs: list[str]) -> list[Path]:
+    """
+    Expand batch inputs into a de-duplicated, ordered list of PDF paths.
+
+    Each spec may be a directory (searched recursively for *.pdf), a glob
+    pattern, a manifest file (one path per line, '#' comments, relative
+    paths resolved against the manifest's folder) or a single PDF.
+    """
+    import glob
+
+    found: list[Path] = []
+    for spec in specs:
+        p = Path(spec).expanduser()
+        if p.is_dir():
+            found.extend(sorted(x for x in p.rglob("*") if x.suffix.lower() == ".pdf"))
+        elif p.is_file() and p.suffix.lower() != ".pdf":
+            for line in p.read_text(encoding="utf-8").splitlines():
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    entry = Path(line).expanduser()
+                    found.append(entry if entry.is_absolute() else p.parent / entry)
+        elif p.is_file():
+            found.append(p)
+        else:
+            found.extend(Path(x) for x in sorted(glob.glob(spec, recursive=True)))
+
+    seen, out = set(), []
+    for f in found:
+        key = f.resolve()
+        if key not in seen:
+            seen.add(key)
+            out.append(f)
+    return out
+
+
+async def abatch_process(pdf_paths: list[Path],
+                         *,
+                         excel: bool = True,
+                         overrides: dict[str, str] | None = None,
+                         format_name: str | None = None,
+                         job_no: str | None = None,
+                         export: str = "xlsx") -> dict:
+    """
+    OCR many PDFs through the shared engine, writing ``<stem>_ocr.json`` (and,
+    when *excel*, a table ``<stem>_ocr.xlsx`` – or .csv / .jsonl / .parquet
+    for another *export* kind, see `export_ocr`) next to each input.
+
+    At most BATCH_MAX_DOCS documents are held in memory at once; their chunks
+    all compete for the same MAX_IN_FLIGHT upload slots, so the pool stays
+    full even while one document is being split or written to Excel.
+    Returns an aggregate summary (see `_print_batch_summary`) including the
+    run's `PipelineMetrics.summary` under ``"metrics"``.
+    """
+    spec   = format_registry.get(format_name)
+    suffix = EXPORT_FORMATS[export][1][0]
+    gate   = asyncio.Semaphore(BATCH_MAX_DOCS)
+    stats = {"docs": 0, "pages": 0, "chunks": 0, "failed": [], "elapsed": 0.0}
+    t0    = time.time()
+
+    async def _one(path: Path) -> None:
+        async with gate:
+            try:
+                doc = await asyncio.to_thread(PdfDocument, path)
+                try:
+                    if job_no:
+                        await asyncio.to_thread(doc.stamp_job_number, job_no)
+                    pages   = doc.page_count
+                    results = await acall_fracto_parallel(doc, path.name)
+                finally:
+                    doc.close()
+                del doc
+                await asyncio.to_thread(save_results, results, str(path))
+                if excel:
+                    await asyncio.to_thread(
+                        export_ocr,
+                        results,
+                        str(path.with_name(f"{path.stem}_ocr{suffix}")),
+                        overrides,
+                        kind=export,
+                        mappings=spec,
+                        template_path=spec.template_path,
+                        sheet_name=spec.sheet_name,
+                    )
+            except Exception as exc:
+                logger.error("✗ %s failed: %s", path, exc)
+                stats["failed"].append(str(path))
+                return
+            stats["docs"]   += 1
+            stats["pages"]  += pages
+            stats["chunks"] += len(results)
+            if any(r.get("status") != "ok" for r in results):
+                stats["failed"].append(str(path))
+
+    with collect_metrics() as run_metrics:
+        await asyncio.gather(*(_one(p) for p in pdf_paths))
+    stats["elapsed"] = time.time() - t0
+    stats["metrics"] = run_metrics.summary()
+    return stats
+
+
+def batch_process(pdf_paths: list[Path], **kwargs) -> dict:
+    """Blocking wrapper around `abatch_process`."""
+    return _engine.run(abatch_process(pdf_paths, **kwargs))
+
+
+def _print_batch_summary(stats: dict) -> None:
+    minutes = max(stats["elapsed"], 1e-9) / 60
+    print(
+        f"\nProcessed {stats['docs']} document(s), {stats['pages']} page(s), "
+        f"{stats['chunks']} chunk(s) in {stats['elapsed']:.1f}s\n"
+        f"  throughput : {stats['docs'] / minutes:.1f} docs/min, "
+        f"{stats['pages'] / minutes:.1f} pages/min\n"
+        f"  failures   : {len(stats['failed'])}"
+    )
+    for f in stats["failed"]:
+        print(f"    ✗ {f}")
+    run = stats.get("metrics")
+    if run:
+        retries = sum((run["counters"].get("retries_total") or {}).values())
+        print(f"  retries    : {retries}")
+        deduped = run["counters"].get("pages_deduplicated_total")
+        if deduped:
+            print(f"  dedup      : {sum(deduped.values())} repeated page(s) not uploaded")
+        skipped = run["counters"].get("pages_skipped_total")
+        if skipped:
+            print(f"  prescan    : {sum(skipped.values())} blank page(s) not uploaded")
+        for stage, h in (run["histograms"].get("stage_seconds") or {}).items():
+            print(f"  {stage:<10} : n={h['count']:<5} p50={h['p50_s']:.2f}s "
+                  f"p95={h['p95_s']:.2f}s max={h['max_s']:.2f}s")
+
+
+def _batch_cli(args: list[str]) -> None:
+    """
+    python -m mcc --batch <dir|glob|manifest> [...] [--format NAME]
+                  [--job JOB_NO] [--export xlsx|csv|jsonl|parquet] [--no-excel]
+                  [KEY=VALUE ...]
+    """
+    specs, overrides = [], {}
+    format_name, job_no, excel, export = None, None, True, "xlsx"
+    it = iter(args)
+    for arg in it:
+        if arg == "--format":
+            format_name = next(it, None)
+        elif arg == "--job":
+            job_no = next(it, None)
+        elif arg == "--export":
+            export = next(it, None)
+        elif arg == "--no-excel":
+            excel = False
+        elif "=" in arg and not Path(arg).exists():
+            k, v = arg.split("=", 1)
+            overrides[k.strip()] = v
+        else:
+            specs.append(arg)
+
+    if export not in EXPORT_FORMATS:
+        logger.error("--export must be one of: %s", ", ".join(EXPORT_FORMATS))
+        sys.exit(1)
+    if format_name and format_name not in format_registry.names():
+        logger.error("Unknown format %r (choose from: %s)",
+                     format_name, ", ".join(format_registry.names()))
+        sys.exit(1)
+    pdfs = _collect_pdfs(specs)
+    if not pdfs:
+        logger.error("No PDFs found in: %s", " ".join(specs) or "<nothing>")
+        sys.exit(2)
+
+    logger.info("Batch: %d PDF(s)", len(pdfs))
+    stats = batch_process(pdfs, excel=excel, overrides=overrides,
+                          format_name=format_name, job_no=job_no, export=export)
+    _print_batch_summary(stats)
+    sys.exit(1 if stats["failed"] else 0)
+
+
+# ─── Background jobs ─────────────────────────────────────────────────────
+JOB_WORKERS = int(os.getenv("FRACTO_JOB_WORKERS", str(BATCH_MAX_DOCS)))   # documents at once
+JOB_TTL_S   = float(os.getenv("FRACTO_JOB_TTL_S", "3600"))   # keep finished jobs this long
+
+
+class Job:
+    """
+    State of one submitted job, updated by its worker and read by pollers.
+
+    ``state`` moves queued → running → done | error; ``progress`` is a
+    0…1 fraction with a human-readable ``message``, and ``chunks`` the
+    (finished, total) chunk counts reported by `call_fracto_parallel`.
+    ``metrics`` collects the pipeline metrics of this job only; its
+    `PipelineMetrics.summary` is the per-job JSON report.
+    """
+
+    def __init__(self, job_id: str, name: str):
+        self.id       = job_id
+        self.name     = name
+        self.state    = "queued"
+        self.progress = 0.0
+        self.message  = "Queued"
+        self.chunks   = (0, 0)
+        self.result: Any = None
+        self.error: str | None = None
+        self.created  = time.time()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.metrics  = PipelineMetrics()
+
+    @property
+    def active(self) -> bool:
+        return self.state in ("queued", "running")
+
+    def update(self, progress: float | None = None, message: str | None = None) -> None:
+        if progress is not None:
+            self.progress = min(max(progress, 0.0), 1.0)
+        if message is not None:
+            self.message = message
+
+    def chunk_reporter(self, start: float = 0.0, end: float = 1.0):
+        """
+        `on_chunk` callback for `call_fracto_parallel` that maps chunk
+        completion onto the [start, end] slice of this job's progress.
+        """
+        def _on_chunk(result: dict | None, done: int, total: int) -> None:
+            self.chunks = (done, total)
+            self.update(start + (end - start) * done / max(total, 1),
+                        f"OCR: {done}/{total} chunk(s) done")
+        return _on_chunk
+
+
+class JobManager:
+    """
+    Process-wide queue of background jobs on a shared thread pool.
+
+    ``submit(fn, *args)`` runs ``fn(job, *args)`` on one of JOB_WORKERS
+    threads and returns a job id straight away; callers (e.g. Streamlit
+    sessions, which re-run their script on every interaction) keep only the
+    id and poll `get`. Uploads of all jobs still share the engine's
+    MAX_IN_FLIGHT budget, so one large PDF cannot starve the others, and
+    jobs beyond JOB_WORKERS wait in FIFO order. Finished jobs are dropped
+    after JOB_TTL_S.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self._lock = threading.Lock()
+        self._jobs: dict[str, Job] = {}
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="fracto-job")
+
+    def submit(self, fn, *args, name: str = "", **kwargs) -> str:
+        import uuid
+        job = Job(uuid.uuid4().hex[:12], name)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        logger.info("Job %s queued (%s)", job.id, name or fn.__name__)
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def _run(self, job: Job, fn, args, kwargs) -> None:
+        job.state, job.started = "running", time.time()
+        job.update(message="Starting")
+        job.metrics.reset()
+        try:
+            with collect_metrics(job.metrics):
+                job.result = fn(job, *args, **kwargs)
+            job.state = "done"
+            job.update(1.0, "Done")
+        except Exception as exc:
+            logger.exception("Job %s failed", job.id)
+            job.error, job.state = str(exc), "error"
+            job.update(message=f"Failed: {exc}")
+        finally:
+            job.finished = time.time()
+
+    def _prune(self) -> None:
+        cutoff = time.time() - JOB_TTL_S
+        for jid in [j.id for j in self._jobs.values() if j.finished and j.finished < cutoff]:
+            del self._jobs[jid]
+
+    def get(self, job_id: str | None) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id) if job_id else None
+
+    def queued_ahead(self, job_id: str) -> int:
+        """How many queued jobs were submitted before *job_id*."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state != "queued":
+                return 0
+            return sum(1 for j in self._jobs.values()
+                       if j.state == "queued" and j.created < job.created)
+
+
+job_manager = JobManager()
+
+
+# ─── Import-time budget ───────────────────────────────────────────────
+IMPORT_BUDGET_MS = float(os.getenv("FRACTO_IMPORT_BUDGET_MS", "100"))
+# Heavy modules that must only load on the code path that needs them
+_LAZY_MODULES = ("openpyxl", "PyPDF2", "httpx", "yaml", "pandas", "reportlab")
+
+
+def measure_import_time(module: str = "mcc", runs: int = 5) -> dict:
+    """
+    Cold-import *module* in *runs* fresh interpreters (``python -X importtime``)
+    and return {"median_ms", "runs_ms", "slowest", "eager"}: the median
+    cumulative import time, the costliest direct imports of the last run and
+    any `_LAZY_MODULES` that got loaded eagerly.
+    """
+    import importlib.util
+    import py_compile
+    import statistics
+    import subprocess
+
+    # Measure against up-to-date bytecode, as a deployed image would have it
+    # (PYTHONDONTWRITEBYTECODE would otherwise make every run recompile).
+    spec = importlib.util.find_spec(module)
+    if spec and spec.origin and spec.origin.endswith(".py"):
+        try:
+            py_compile.compile(spec.origin, doraise=True)
+        except (OSError, py_compile.PyCompileError):
+            pass
+
+    probe = (f"import sys, {module}; "
+             f"print(' '.join(m for m in {_LAZY_MODULES!r} if m in sys.modules))")
+    runs_ms, eager, slowest = [], set(), []
+    for _ in range(max(1, runs)):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", probe],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True,
+        )
+        eager.update(proc.stdout.split())
+        children = []
+        for line in proc.stderr.splitlines():
+            parts = line.split("|")
+            if len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            name, cumulative_ms = parts[2], int(parts[1]) / 1000
+            depth = len(name) - len(name.lstrip(" "))
+            if depth == 1:                      # a top-level import finished
+                if name.strip() == module:
+                    runs_ms.append(cumulative_ms)
+                    slowest = sorted(children, reverse=True)[:5]
+                children = []
+            elif depth == 3:
+                children.append((cumulative_ms, name.strip()))
+    return {
+        "median_ms": statistics.median(runs_ms) if runs_ms else 0.0,
+        "runs_ms":   runs_ms,
+        "slowest":   slowest,
+        "eager":     sorted(eager),
+    }
+
+
+def _import_time_cli(args: list[str]) -> None:
+    """`--import-time [BUDGET_MS]`: exit 1 when `import mcc` is over budget."""
+    budget = float(args[0]) if args else IMPORT_BUDGET_MS
+    report = measure_import_time()
+    print(f"import mcc: {report['median_ms']:.1f} ms median "
+          f"({', '.join(f'{t:.0f}' for t in report['runs_ms'])}) – budget {budget:.0f} ms")
+    for ms, name in report["slowest"]:
+        print(f"  {ms:8.1f} ms  {name}")
+    if report["eager"]:
+        print(f"  eagerly imported: {', '.join(report['eager'])}")
+    sys.exit(0 if report["median_ms"] <= budget and not report["eager"] else 1)
+
+
 # ─── CLI ─────────────────────────────────────────────────────────────────
 def _cli():
     """
     Usage:
-        python -m mcc <pdf-path> [output.json] [output.xlsx] [KEY=VALUE ...]
+        python -m mcc <pdf-path> [output.json] [output.xlsx|.csv|.jsonl|.parquet]
+                      [KEY=VALUE ...]
+        python -m mcc --batch <dir|glob|manifest> [...] [--format NAME] [--job JOB_NO]
+                      [--export xlsx|csv|jsonl|parquet] [--no-excel] [KEY=VALUE ...]
+        python -m mcc --resume <results.json> <pdf-path> [output.xlsx|.csv|.jsonl|.parquet]
+                      [--format NAME] [KEY=VALUE ...]
+        python -m mcc --import-time [BUDGET_MS]
+
+    Add ``--metrics FILE`` to any mode to dump pipeline metrics on exit
+    (Prometheus text for .prom/.txt, JSON summary otherwise).
+    Add ``--dedup reuse|drop`` to upload repeated pages only once (see
+    `plan_chunks`; FRACTO_DEDUP_RECENT also matches across documents).
+    Add ``--prescan`` to skip blank pages and cut chunks between invoices
+    using the PDF's text layer (FRACTO_INVOICE_PATTERN, FRACTO_BLANK_MAX_CHARS).
+    Add ``--record DIR`` to store every Fracto response under DIR, or
+    ``--replay DIR`` to answer from such a recording without network or API
+    key (FRACTO_REPLAY_SPEED=1 reproduces the recorded timing).
 
     Convenience:
-        • If you pass only two arguments and the second one ends with .xlsx / .xlsm / .xls,
-          it is treated as the Excel output, and the JSON will default to
-          "<pdf‑stem>_ocr.json" next to the PDF.
+        • If you pass only two arguments and the second one ends with .xlsx / .xlsm / .xls
+          (or .csv / .jsonl / .parquet), it is treated as the table output, and the JSON
+          will default to "<pdf‑stem>_ocr.json" next to the PDF. The table format
+          follows the suffix; CSV, JSON Lines and Parquet skip workbook generation.
         • Any KEY=VALUE pairs will be written or overwritten in every row of the Excel output.
+        • --batch runs every PDF through one shared upload pool, writes
+          "<stem>_ocr.json" / "<stem>_ocr.xlsx" next to each input and prints
+          docs/min, pages/min and failures at the end.
+        • --resume reloads a saved results JSON, re-submits only the chunks
+          that errored, renumbers serials and rewrites the JSON and Excel.
+        • --import-time cold-imports mcc a few times and fails if the median
+          exceeds FRACTO_IMPORT_BUDGET_MS or a heavy dependency loads eagerly.
     """
     if len(sys.argv) < 2:
-        print("Usage: python -m mcc <pdf-path> [output.json] [output.xlsx] [KEY=VALUE ...]")
+        print("Usage: python -m mcc <pdf-path> [output.json] [output.xlsx|.csv|.jsonl|.parquet] "
+              "[KEY=VALUE ...]\n"
+              "       python -m mcc --batch <dir|glob|manifest> [...] [--format NAME] "
+              "[--job JOB_NO] [--export xlsx|csv|jsonl|parquet] [--no-excel] [KEY=VALUE ...]\n"
+              "       python -m mcc --resume <results.json> <pdf-path> "
+              "[output.xlsx|.csv|.jsonl|.parquet] [--format NAME] [KEY=VALUE ...]\n"
+              "       python -m mcc --import-time [BUDGET_MS]\n"
+              "       (any mode) --metrics <out.prom|out.json> --record DIR | --replay DIR\n"
+              "                  --dedup reuse|drop --prescan")
         sys.exit(1)
 
+    global transport, DEDUP_POLICY, PRESCAN
     args = sys.argv[1:]
 
+    def _pop_option(flag: str, what: str = "a path") -> str | None:
+        if flag not in args:
+            return None
+        i = args.index(flag)
+        if i + 1 >= len(args):
+            logger.error("%s needs %s", flag, what)
+            sys.exit(1)
+        value = args[i + 1]
+        del args[i:i + 2]
+        return value
+
+    metrics_out = _pop_option("--metrics")
+    if metrics_out:
+        import atexit
+        atexit.register(write_metrics, metrics_out)
+    dedup = _pop_option("--dedup", "a policy (off, reuse or drop)")
+    if dedup:
+        if dedup not in ("off", "reuse", "drop"):
+            logger.error("--dedup must be off, reuse or drop")
+            sys.exit(1)
+        DEDUP_POLICY = dedup
+    if "--prescan" in args:
+        args.remove("--prescan")
+        PRESCAN = True
+    for mode in ("record", "replay"):
+        root = _pop_option(f"--{mode}", "a directory")
+        if root:
+            transport = make_transport(mode, Path(root))
+            logger.info("Transport: %s (%s)", mode, root)
+    if not args:
+        logger.error("Nothing to run")
+        sys.exit(1)
+    if args[0] == "--import-time":
+        _import_time_cli(args[1:])
+        return
+    if args[0] == "--batch":
+        _batch_cli(args[1:])
+        return
+    if args[0] == "--resume":
+        _resume_cli(args[1:])
+        return
+
     pdf_path     = args[0]
     json_out     = None
     excel_out    = None
@@ -316,9 +2775,9 @@ def _cli():
             overrides[k.strip()] = v
         else:
             remaining.append(arg)
-    # Re‑interpret remaining (non‑override) args for json/excel outputs
+    # Re‑interpret remaining (non‑override) args for json/table outputs
     if remaining:
-        if remaining[0].lower().endswith((".xlsx", ".xlsm", ".xls")):
+        if export_kind(remaining[0]):
             excel_out = remaining[0]
         else:
             json_out = remaining[0]
@@ -334,9 +2793,9 @@ def _cli():
     # save JSON (use default if not supplied)
     save_results(results, pdf_path, json_out)
 
-    # save Excel if requested
+    # save Excel / CSV / JSONL / Parquet if requested
     if excel_out:
-        write_excel_from_ocr(results, excel_out, overrides)
+        export_ocr(results, excel_out, overrides, kind=export_kind(excel_out) or "xlsx")
 
 
 
@@ -361,7 +2820,7 @@ def _extract_rows(payload: Any) -> List[Dict[str, Any]]:
             if isinstance(maybe, list):
                 return [r for r in maybe if isinstance(r, dict)]
         # treat dict itself as a single row if it shares keys
-        if any(k in payload for k in HEADERS):
+        if any(k in payload for k in format_registry.get().headers):
             return [payload]
 
     # Fallback: look inside `parsedData` for the first list of dicts
@@ -375,48 +2834,222 @@ def _extract_rows(payload: Any) -> List[Dict[str, Any]]:
     return []  # fallback
 
 
+# ─── Columnar OCR table ──────────────────────────────────────────────────
+class OcrTable:
+    """
+    OCR rows normalised once into column arrays keyed by mapped header.
+
+    Built in a single pass over the chunk results (one `_extract_rows` per
+    chunk, one dict lookup per cell), then shared by every consumer – serial
+    renumbering, the Excel writers and the Streamlit grid/stats – so nothing
+    downstream re-walks the raw JSON or re-reads a written workbook.
+    """
+
+    def __init__(self, headers: list[str], columns: dict[str, list],
+                 fields: dict[str, str] | None = None):
+        self.headers = headers
+        self.columns = columns
+        self.fields  = {h: h for h in headers} if fields is None else fields   # header → source field
+
+    @classmethod
+    def from_results(cls, results: List[Dict[str, Any]],
+                     mappings: "dict[str, str] | FormatSpec | None" = None,
+                     overrides: dict[str, str] | None = None) -> "OcrTable":
+        if isinstance(mappings, FormatSpec):
+            spec = mappings
+        elif mappings:
+            spec = FormatSpec("<ad hoc>", {"mappings": mappings})
+        else:
+            spec = format_registry.get()
+        return spec.table(results, overrides)
+
+    def __len__(self) -> int:
+        return len(self.columns[self.headers[0]]) if self.headers else 0
+
+    def rows(self) -> Iterator[tuple]:
+        """Row tuples in header order."""
+        return zip(*(self.columns[h] for h in self.headers))
+
+    def longest(self) -> list[int]:
+        """Longest rendered value per column (header included)."""
+        return [
+            max([len(str(h))] + [len(str(v)) for v in self.columns[h] if v is not None])
+            for h in self.headers
+        ]
+
+    def renumber(self, json_field: str = "Serial_Number", start: int = 1) -> None:
+        """
+        Columnar `_renumber_serials`: rewrite every column sourced from
+        *json_field* as start, start+1, …
+        """
+        n = len(self)
+        for h in self.headers:
+            if self.fields.get(h) == json_field:
+                self.columns[h] = list(range(start, start + n))
+
+    def to_dataframe(self):
+        """pandas view for the UI; blank OCR values become NA like in a re-read xlsx."""
+        import pandas as pd
+        df = pd.DataFrame(
+            {h: [None if v == "" else v for v in self.columns[h]] for h in self.headers},
+            columns=self.headers,
+        )
+        return df.infer_objects()
+
+    @classmethod
+    def from_dataframe(cls, df) -> "OcrTable":
+        """Inverse of `to_dataframe` (e.g. for edited grids); NA becomes blank again."""
+        headers = [str(c) for c in df.columns]
+        columns = {h: df[c].astype(object).where(df[c].notna(), "").tolist()
+                   for h, c in zip(headers, df.columns)}
+        return cls(headers, columns)
+
+
+# ─── Excel template cache ────────────────────────────────────────────────
+class TemplateCache:
+    """
+    Parse each Excel template once and hand out cheap private copies.
+
+    For every (template, sheet) pair the workbook is loaded, its target sheet
+    cleared, and the result kept as xlsx bytes; each job then re-opens those
+    bytes, which is a fraction of the cost of parsing the original template
+    and leaves no shared mutable state between callers. Entries are rebuilt
+    when the file's mtime or size changes. Safe to share between Streamlit
+    sessions and batch workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[tuple[str, str | None], tuple[tuple[int, int], bytes]] = {}
+
+    def workbook(self, path: str | Path, sheet_name: str | None = None) -> "Workbook":
+        from openpyxl import load_workbook
+        path  = Path(path).expanduser().resolve()
+        st    = path.stat()
+        stamp = (st.st_mtime_ns, st.st_size)
+        key   = (str(path), sheet_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != stamp:
+                logger.info("Parsing Excel template %s", path.name)
+                entry = self._entries[key] = (stamp, self._prepare(path, sheet_name))
+        return load_workbook(io.BytesIO(entry[1]))
+
+    @staticmethod
+    def _prepare(path: Path, sheet_name: str | None) -> bytes:
+        from openpyxl import load_workbook
+        wb = load_workbook(path)
+        ws = wb[sheet_name] if sheet_name and sheet_name in wb.sheetnames else wb.active
+        ws.delete_rows(1, ws.max_row)
+        buf = io.BytesIO()
+        wb.save(buf)
+        return buf.getvalue()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+template_cache = TemplateCache()
+
+
+# Sheet styling shared by the regular and streaming Excel writers
+@functools.lru_cache(maxsize=None)
+def _sheet_styles() -> SimpleNamespace:
+    from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+    thin = Side(border_style="thin", color="999999")
+    return SimpleNamespace(
+        header_font  = Font(bold=True, color="FFFFFF"),
+        header_fill  = PatternFill("solid", fgColor="305496"),
+        header_align = Alignment(vertical="center", horizontal="center", wrap_text=True),
+        border       = Border(left=thin, right=thin, top=thin, bottom=thin),
+        body_align   = Alignment(vertical="top", wrap_text=True),
+        stripe_fill  = PatternFill("solid", fgColor="F2F2F2"),
+    )
+
+
+_MAX_COL_WIDTH = 60
+
+
+def _column_width(longest: int) -> int:
+    return min(max(longest + 2, 10), _MAX_COL_WIDTH)
+
+
 def write_excel_from_ocr(
-    results: List[Dict[str, Any]],
+    results: "List[Dict[str, Any]] | OcrTable",
     output_path: str | io.BytesIO,
     overrides: dict[str, str] | None = None,
     *,
     mappings: dict[str, str] | None = None,
     template_path: str | None = None,
     sheet_name: str | None = None,
+    streaming: bool | None = None,
 ):
     """
     Write OCR rows to *output_path*.
 
     Parameters
     ----------
-    results : list[dict]
-        Fracto API responses (or pre‑loaded JSON) – list of results.
+    results : list[dict] | OcrTable
+        Fracto API responses (or pre‑loaded JSON) – list of results – or an
+        `OcrTable` already built from them (*mappings*/*overrides* are then
+        ignored, they were applied when the table was built).
     output_path : str | io.BytesIO
         Where to write the Excel workbook.
     overrides : dict[str, str], optional
         {column_name: value} pairs forced into every row (e.g. constant HS‑Code).
     mappings : dict[str, str], optional
-        Column → source‑field mapping. Defaults to the global MAPPINGS.
+        Column → source‑field mapping (or a compiled `FormatSpec`). Defaults
+        to the registry's default format.
     template_path : str | Path, optional
         Path to an .xlsx template to use as a base (preserves styles).
     sheet_name : str, optional
         Which sheet inside the template/workbook to write into. Defaults to the
         first/active sheet.
+    streaming : bool, optional
+        Use openpyxl's write-only mode (constant memory, styles shared per
+        column instead of per cell). Defaults to True unless a template is
+        used – templates need the regular, editable workbook.
     """
-    mappings = mappings or MAPPINGS
-    template_path = template_path or TEMPLATE_PATH
-    sheet_name = sheet_name or SHEET_NAME
-    overrides = overrides or {}
-
-    headers = list(mappings.keys())
+    default = format_registry.get()
+    template_path = template_path or default.template_path
+    sheet_name = sheet_name or default.sheet_name
 
-    # Keep only overrides whose column exists in the header list
-    overrides = {k: v for k, v in overrides.items() if k in headers}
+    if isinstance(results, OcrTable):
+        table = results
+    else:
+        table = OcrTable.from_results(results, mappings, overrides)
+    with _stage("excel"):
+        _write_excel_table(table, output_path, template_path, sheet_name, streaming)
+
+
+def _write_excel_table(table: OcrTable, output_path: str | io.BytesIO,
+                       template_path: str | None, sheet_name: str | None,
+                       streaming: bool | None) -> None:
+    """Body of `write_excel_from_ocr` once the rows are in an `OcrTable`."""
+    headers = table.headers
+
+    has_template = bool(template_path) and Path(template_path).expanduser().exists()
+    if streaming is None:
+        streaming = not has_template
+    elif streaming and has_template:
+        logger.warning("Streaming mode ignores template %s", template_path)
+
+    if streaming:
+        written = _write_excel_streaming(table, output_path)
+        logger.info(
+            "Excel written to %s (%d rows, %d columns)",
+            output_path if isinstance(output_path, str) else "<buffer>",
+            written,
+            len(headers),
+        )
+        return
 
-    # Load or create workbook
-    if template_path and Path(template_path).expanduser().exists():
-        wb = load_workbook(Path(template_path).expanduser())
+    # Load or create workbook (templates come pre-cleared from the cache)
+    if has_template:
+        wb = template_cache.workbook(template_path, sheet_name)
     else:
+        from openpyxl import Workbook
         wb = Workbook()
 
     # Select or create target sheet
@@ -425,61 +3058,38 @@ def write_excel_from_ocr(
     else:
         ws = wb.active
 
-    # Clear existing data
-    ws.delete_rows(1, ws.max_row)
-
-    # ── Gather rows from results ──
-    all_rows: list[dict] = []
-    for result in results:
-        payload = result.get("data", [])
-        rows = _extract_rows(payload)
-        all_rows.extend(rows)
-
     # Header row
     ws.append(headers)
 
     # Write data rows
     written = 0
-    for row in all_rows:
-        excel_row = []
-        for col in headers:
-            src_field = mappings.get(col, col)
-            value = overrides.get(col, row.get(src_field, ""))
-            excel_row.append(value)
+    for excel_row in table.rows():
         ws.append(excel_row)
         written += 1
 
     # ── Styling (same as before) ──
-    header_font  = Font(bold=True, color="FFFFFF")
-    header_fill  = PatternFill("solid", fgColor="305496")
-    header_align = Alignment(vertical="center", horizontal="center", wrap_text=True)
-    thin_border  = Side(border_style="thin", color="999999")
-    border       = Border(left=thin_border, right=thin_border, top=thin_border, bottom=thin_border)
-
+    sty = _sheet_styles()
     for cell in ws[1]:
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_align
-        cell.border = border
+        cell.font = sty.header_font
+        cell.fill = sty.header_fill
+        cell.alignment = sty.header_align
+        cell.border = sty.border
 
-    max_width = 60
     for column in ws.iter_cols(min_row=1, max_row=ws.max_row):
         longest = max(len(str(c.value)) if c.value is not None else 0 for c in column)
-        width = min(max(longest + 2, 10), max_width)
-        ws.column_dimensions[column[0].column_letter].width = width
+        ws.column_dimensions[column[0].column_letter].width = _column_width(longest)
         for c in column[1:]:
-            c.border = border
-            c.alignment = Alignment(vertical="top", wrap_text=True)
+            c.border = sty.border
+            c.alignment = sty.body_align
 
     ws.freeze_panes = "A2"
     ws.sheet_view.showGridLines = True
 
     # Zebra striping for readability
-    stripe_fill = PatternFill("solid", fgColor="F2F2F2")
     for r in range(2, ws.max_row + 1):
         if r % 2 == 0:
             for c in ws[r]:
-                c.fill = stripe_fill
+                c.fill = sty.stripe_fill
 
     # Save
     if isinstance(output_path, io.BytesIO):
@@ -494,6 +3104,519 @@ def write_excel_from_ocr(
         len(headers),
     )
 
+
+def _write_excel_streaming(table: OcrTable, output_path: str | io.BytesIO) -> int:
+    """
+    Write-only counterpart of `write_excel_from_ocr`; returns the row count.
+
+    Column widths must be known before the first row is streamed; the table
+    already holds the values column-wise, so they are measured up front
+    without touching any cell object. Each column has one pre-styled cell
+    for plain rows and one for zebra rows; only their values change per row,
+    so the number of style objects is constant no matter how many rows we
+    emit.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.utils import get_column_letter
+
+    headers = table.headers
+    longest = table.longest()
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet")
+    for i, n in enumerate(longest, 1):
+        ws.column_dimensions[get_column_letter(i)].width = _column_width(n)
+    ws.freeze_panes = "A2"
+    ws.sheet_view.showGridLines = True
+
+    sty = _sheet_styles()
+
+    def _styled(fill=None, header: bool = False) -> WriteOnlyCell:
+        c = WriteOnlyCell(ws)
+        c.border = sty.border
+        if header:
+            c.font, c.fill, c.alignment = sty.header_font, sty.header_fill, sty.header_align
+        else:
+            c.alignment = sty.body_align
+            if fill is not None:
+                c.fill = fill
+        return c
+
+    header_cells = []
+    for h in headers:
+        c = _styled(header=True)
+        c.value = h
+        header_cells.append(c)
+    ws.append(header_cells)
+
+    # Excel row 2 is the first data row and is striped (even rows).
+    striped = [_styled(sty.stripe_fill) for _ in headers]
+    plain   = [_styled() for _ in headers]
+    written = 0
+    for values in table.rows():
+        cells = striped if written % 2 == 0 else plain
+        for c, v in zip(cells, values):
+            c.value = v
+        ws.append(cells)
+        written += 1
+
+    wb.save(output_path if isinstance(output_path, io.BytesIO) else str(output_path))
+    return written
+
+
+# ─── Flat-file exporters ─────────────────────────────────────────────────
+# CSV, JSON Lines and Parquet for consumers that don't want a workbook (ERP
+# importers, the warehouse loader). They read the same `OcrTable` as the
+# Excel writers, so mapping.yaml headers, field mappings and overrides apply
+# unchanged, and they write EXPORT_BATCH_ROWS rows at a time without any
+# per-cell objects. pyarrow is only needed (and imported) for Parquet.
+EXPORT_BATCH_ROWS = int(os.getenv("FRACTO_EXPORT_BATCH_ROWS", "10000"))
+
+EXPORT_FORMATS = {                # kind → (label, suffixes, MIME type)
+    "xlsx":    ("Excel", (".xlsx", ".xlsm", ".xls"),
+                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv":     ("CSV", (".csv",), "text/csv"),
+    "jsonl":   ("JSON Lines", (".jsonl", ".ndjson"), "application/x-ndjson"),
+    "parquet": ("Parquet", (".parquet", ".pq"), "application/vnd.apache.parquet"),
+}
+
+
+def export_kind(path: str | Path) -> str | None:
+    """Export kind for *path*'s suffix (see EXPORT_FORMATS), None if unknown."""
+    suffix = Path(path).suffix.lower()
+    return next((k for k, (_, suffixes, _) in EXPORT_FORMATS.items() if suffix in suffixes), None)
+
+
+def export_ocr(
+    results: "List[Dict[str, Any]] | OcrTable",
+    output_path: str | io.BytesIO,
+    overrides: dict[str, str] | None = None,
+    *,
+    kind: str | None = None,
+    mappings: "dict[str, str] | FormatSpec | None" = None,
+    template_path: str | None = None,
+    sheet_name: str | None = None,
+) -> None:
+    """
+    Write OCR rows as xlsx, CSV, JSON Lines or Parquet.
+
+    Parameters
+    ----------
+    results : list[dict] | OcrTable
+        As for `write_excel_from_ocr`.
+    output_path : str | io.BytesIO
+        Target file or buffer.
+    overrides, mappings :
+        As for `write_excel_from_ocr` (ignored for an `OcrTable`).
+    kind : str, optional
+        One of EXPORT_FORMATS; inferred from *output_path*'s suffix when
+        omitted (required for a buffer).
+    template_path, sheet_name : optional
+        Only used for ``"xlsx"``, which is delegated to `write_excel_from_ocr`.
+    """
+    if kind is None and not isinstance(output_path, io.BytesIO):
+        kind = export_kind(output_path)
+    if kind not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {kind!r} for {output_path!r} "
+                         f"(choose from: {', '.join(EXPORT_FORMATS)})")
+    if kind == "xlsx":
+        write_excel_from_ocr(results, output_path, overrides, mappings=mappings,
+                             template_path=template_path, sheet_name=sheet_name)
+        return
+
+    if isinstance(results, OcrTable):
+        table = results
+    else:
+        table = OcrTable.from_results(results, mappings, overrides)
+    with _stage("export"):
+        _EXPORTERS[kind](table, output_path)
+    logger.info(
+        "%s written to %s (%d rows, %d columns)",
+        EXPORT_FORMATS[kind][0],
+        output_path if isinstance(output_path, str) else "<buffer>",
+        len(table),
+        len(table.headers),
+    )
+
+
+@contextlib.contextmanager
+def _export_stream(output_path: str | io.BytesIO, text: bool):
+    """Open *output_path* for writing; a buffer is written in place, not closed."""
+    if not isinstance(output_path, io.BytesIO):
+        with (open(output_path, "w", encoding="utf-8", newline="") if text
+              else open(output_path, "wb")) as fh:
+            yield fh
+    elif text:
+        fh = io.TextIOWrapper(output_path, encoding="utf-8", newline="")
+        try:
+            yield fh
+        finally:
+            fh.flush()
+            fh.detach()
+    else:
+        yield output_path
+
+
+def _row_batches(table: OcrTable) -> Iterator[list[tuple]]:
+    rows = table.rows()
+    while batch := list(itertools.islice(rows, EXPORT_BATCH_ROWS)):
+        yield batch
+
+
+def _write_csv(table: OcrTable, output_path: str | io.BytesIO) -> None:
+    import csv
+    with _export_stream(output_path, text=True) as fh:
+        writer = csv.writer(fh)
+        writer.writerow(table.headers)
+        for batch in _row_batches(table):
+            writer.writerows(batch)
+
+
+def _write_jsonl(table: OcrTable, output_path: str | io.BytesIO) -> None:
+    encode  = json.JSONEncoder(ensure_ascii=False, default=str).encode
+    headers = table.headers
+    with _export_stream(output_path, text=True) as fh:
+        for batch in _row_batches(table):
+            fh.write("".join(encode(dict(zip(headers, row))) + "\n" for row in batch))
+
+
+def _arrow_column(values: list):
+    """
+    (pyarrow type, values) for one column. Blank OCR values become nulls; a
+    column whose other values are all ints, all numbers or all bools keeps
+    that type, anything mixed is written as strings.
+    """
+    import pyarrow as pa
+    values = [None if v == "" else v for v in values]
+    kinds  = {type(v) for v in values if v is not None}
+    if kinds == {bool}:
+        return pa.bool_(), values
+    if kinds == {int}:
+        return pa.int64(), values
+    if kinds and kinds <= {int, float}:
+        return pa.float64(), values
+    return pa.string(), [v if v is None or isinstance(v, str) else str(v) for v in values]
+
+
+def _write_parquet(table: OcrTable, output_path: str | io.BytesIO) -> None:
+    """One row group per EXPORT_BATCH_ROWS rows, sliced straight from the columns."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as exc:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)") from exc
+
+    columns = [_arrow_column(table.columns[h]) for h in table.headers]
+    schema  = pa.schema([(h, t) for h, (t, _) in zip(table.headers, columns)])
+    with _export_stream(output_path, text=False) as fh:
+        with pq.ParquetWriter(fh, schema) as writer:
+            for start in range(0, max(len(table), 1), EXPORT_BATCH_ROWS):
+                stop = start + EXPORT_BATCH_ROWS
+                writer.write_batch(pa.record_batch(
+                    [pa.array(values[start:stop], type=t) for t, values in columns],
+                    schema=schema))
+
+
+_EXPORTERS = {"csv": _write_csv, "jsonl": _write_jsonl, "parquet": _write_parquet}
+
+
+# ─── Excel edits ─────────────────────────────────────────────────────────
+# Saving grid edits used to re-load the whole workbook in openpyxl and write
+# every cell back; for a few thousand rows × 150 columns the load and save
+# alone take tens of seconds. Instead the grid is diffed against what was
+# shown and only the touched <row>/<c> elements of the worksheet XML are
+# rewritten – every other part of the .xlsx is copied through unchanged.
+_SHEET_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_DOC_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+
+
+def _q(tag: str) -> str:
+    return f"{{{_SHEET_NS}}}{tag}"
+
+
+def diff_frames(before, after) -> dict:
+    """
+    Vectorized diff of the grid the user was shown (*before*) against what
+    `st.data_editor` returned (*after*).
+
+    Rows are matched by index label – the editor keeps the labels of existing
+    rows, never reorders them and gives added rows new labels. Blank cells
+    (None/NaN/NA) compare equal to each other.
+
+    Returns
+    -------
+    dict
+        {"changed": [(row_pos, col_pos, value), …], "deleted": [row_pos, …],
+        "added": [row tuple, …]}, positions relative to *before*.
+    """
+    import numpy as np
+    import pandas as pd
+
+    def _cells(df) -> "np.ndarray":
+        arr = df.to_numpy(dtype=object, copy=True)
+        arr[pd.isna(arr)] = None
+        return arr
+
+    after   = after.reindex(columns=before.columns)
+    kept    = after.index.isin(before.index)
+    deleted = np.flatnonzero(~before.index.isin(after.index)).tolist()
+
+    pos = before.index.get_indexer(after.index[kept])
+    old = _cells(before)[pos]
+    new = _cells(after[kept])
+    rows, cols = np.nonzero(old != new)
+    changed = [(int(pos[r]), int(c), new[r, c]) for r, c in zip(rows, cols)]
+    added   = [tuple(r) for r in _cells(after[~kept])]
+    return {"changed": changed, "deleted": deleted, "added": added}
+
+
+def _sheet_part(zf, sheet_name: str | None) -> str:
+    """Zip path of *sheet_name* (or the active sheet) inside an .xlsx."""
+    from lxml import etree
+    book  = etree.fromstring(zf.read("xl/workbook.xml"))
+    view  = book.find(f"{_q('bookViews')}/{_q('workbookView')}")
+    sheets = list(book.find(_q("sheets")))
+    chosen = next((sh for sh in sheets if sheet_name and sh.get("name") == sheet_name), None)
+    if chosen is None:
+        active = int(view.get("activeTab", 0)) if view is not None else 0
+        chosen = sheets[min(active, len(sheets) - 1)]
+    rid  = chosen.get(f"{{{_DOC_REL_NS}}}id")
+    rels = etree.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    target = next(r.get("Target") for r in rels if r.get("Id") == rid)
+    return target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+
+
+def _set_cell_value(cell, value) -> None:
+    """Replace a <c> element's content, keeping its style index."""
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+    for child in list(cell):
+        cell.remove(child)
+    cell.attrib.pop("t", None)
+    if hasattr(value, "item"):                 # numpy scalar → Python
+        value = value.item()
+    if value is None:
+        return
+    if isinstance(value, bool):
+        cell.set("t", "b")
+        v = cell.makeelement(_q("v"), {})
+        v.text = "1" if value else "0"
+        cell.append(v)
+    elif isinstance(value, int) or (isinstance(value, float) and abs(value) != float("inf")):
+        v = cell.makeelement(_q("v"), {})
+        v.text = repr(value)
+        cell.append(v)
+    else:
+        text = ILLEGAL_CHARACTERS_RE.sub("", str(value))
+        cell.set("t", "inlineStr")
+        inline = cell.makeelement(_q("is"), {})
+        t = inline.makeelement(_q("t"), {})
+        t.text = text
+        if text != text.strip():
+            t.set(_XML_SPACE, "preserve")
+        inline.append(t)
+        cell.append(inline)
+
+
+def _col_letters(ref: str) -> str:
+    return ref.rstrip("0123456789")
+
+
+_ROOT_TAG_RE = re.compile(rb"<(?![?!])[^>]*>")
+_NS_DECL_RE  = re.compile(rb'\sxmlns(?::[\w.-]+)?="[^"]*"')
+_ROW_RE      = re.compile(rb'<row\b[^>]*?\br="(\d+)"')
+_ROW_REF_RE  = re.compile(rb'( r="[A-Z]*)\d+"')     # split → [text, ' r="AB', text, …]
+_STYLE_RE    = re.compile(rb' s="(\d+)"')
+_STYLE_ATTR_RE = re.compile(rb'( s="\d+")')
+_CELL_COL_RE = re.compile(rb'<c\b[^>]*? r="([A-Z]+)')
+_DIM_RE      = re.compile(rb'(<dimension\b[^>]*?\bref="[A-Z]+\d+:[A-Z]+)\d+"')
+
+
+class _RowCodec:
+    """Parse / serialize single <row> chunks of a worksheet with lxml."""
+
+    def __init__(self, root_tag: bytes):
+        from lxml import etree
+        self._etree = etree
+        self._open  = b"<sheetData" + b"".join(_NS_DECL_RE.findall(root_tag)) + b">"
+        self._attrs: dict[tuple, list[bytes]] = {}
+        self._shape: dict[int, tuple[list, list]] = {}
+
+    def shape(self, n: int, chunk: bytes) -> tuple[list, list]:
+        """(style ids, cell columns) of the original row *n*, computed once."""
+        got = self._shape.get(n)
+        if got is None:
+            got = self._shape[n] = (_STYLE_RE.findall(chunk), _CELL_COL_RE.findall(chunk))
+        return got
+
+    @staticmethod
+    def renumber(chunk: bytes, m: int) -> bytes:
+        parts = _ROW_REF_RE.split(chunk)
+        tail = b'%d"' % m
+        parts[1::2] = [p + tail for p in parts[1::2]]
+        return b"".join(parts)
+
+    def parse(self, chunk: bytes):
+        return self._etree.fromstring(self._open + chunk + b"</sheetData>")[0]
+
+    def dump(self, row) -> bytes:
+        out = self._etree.tostring(row)
+        cut = out.index(b">")                  # namespaces live on <worksheet>
+        return _NS_DECL_RE.sub(b"", out[:cut]) + out[cut:]
+
+    def styles(self, chunk: bytes) -> dict[str, str | None]:
+        return {_col_letters(c.get("r", "")): c.get("s") for c in self.parse(chunk)}
+
+    def restyle_like(self, chunk: bytes, n: int, ref: bytes, m: int) -> bytes:
+        """Give *chunk* (original row *n*) the cell styles of original row *m*."""
+        (have, cols), (want, ref_cols) = self.shape(n, chunk), self.shape(m, ref)
+        if have == want:
+            return chunk
+        if len(cols) == len(have) == len(want) and cols == ref_cols:
+            key = tuple(want)                  # every cell styled, same columns:
+            attrs = self._attrs.get(key)       # swap the s="…" attributes
+            if attrs is None:
+                attrs = self._attrs[key] = [b' s="%s"' % w for w in want]
+            parts = _STYLE_ATTR_RE.split(chunk)
+            parts[1::2] = attrs
+            return b"".join(parts)
+        styles = self.styles(ref)
+        row = self.parse(chunk)
+        for c in row:
+            s = styles.get(_col_letters(c.get("r", "")))
+            if s is None:
+                c.attrib.pop("s", None)
+            else:
+                c.set("s", s)
+        return self.dump(row)
+
+
+def _row_cell(row, letter: str):
+    """The <c> for column *letter* in *row*, created in column order if missing."""
+    ref = f"{letter}{row.get('r')}"
+    for i, c in enumerate(row):
+        got = _col_letters(c.get("r", ""))
+        if got == letter:
+            return c
+        if (len(got), got) > (len(letter), letter):
+            new = row.makeelement(_q("c"), {"r": ref})
+            row.insert(i, new)
+            return new
+    new = row.makeelement(_q("c"), {"r": ref})
+    row.append(new)
+    return new
+
+
+def patch_excel(xlsx: bytes, diff: dict, sheet_name: str | None = None,
+                header_rows: int = 1) -> bytes:
+    """
+    Apply a `diff_frames` result to a workbook written by `write_excel_from_ocr`.
+
+    The worksheet XML is cut into <row> chunks and only the rows a diff
+    touches are parsed, so cost scales with the edit, not the sheet.
+    Changed cells keep their style; deleted rows are removed and the rows
+    below move up while formatting stays with the row *position* (zebra
+    stripes stay intact); added rows are appended with the styles of the
+    row two above (same stripe). As with openpyxl's `delete_rows`, merged
+    ranges / tables / conditional formats below deleted rows are not moved.
+
+    Parameters
+    ----------
+    xlsx : bytes
+        The workbook the grid was built from.
+    diff : dict
+        Output of `diff_frames`; row positions count data rows from 0.
+    sheet_name : str, optional
+        Sheet to patch; defaults to the active sheet.
+    header_rows : int
+        Rows above the first data row.
+    """
+    import bisect
+    import zipfile
+    from openpyxl.utils import get_column_letter
+
+    if not (diff["changed"] or diff["deleted"] or diff["added"]):
+        return xlsx
+
+    zin   = zipfile.ZipFile(io.BytesIO(xlsx))
+    part  = _sheet_part(zin, sheet_name)
+    xml   = zin.read(part)
+    codec = _RowCodec(_ROOT_TAG_RE.search(xml).group(0))
+    first = header_rows + 1
+    ncols = max([c + 1 for _, c, _ in diff["changed"]] + [len(r) for r in diff["added"]] + [1])
+    letters = [get_column_letter(i + 1) for i in range(ncols)]
+
+    # Split <sheetData> into head / {row number: chunk} / tail
+    open_at = xml.index(b"<sheetData")
+    start   = xml.index(b">", open_at) + 1
+    if xml[start - 2:start] == b"/>":
+        head, body, tail = xml[:open_at] + b"<sheetData>", b"", b"</sheetData>" + xml[start:]
+    else:
+        end = xml.rindex(b"</sheetData>")
+        head, body, tail = xml[:start], xml[start:end], xml[end:]
+    marks = [(m.start(), int(m.group(1))) for m in _ROW_RE.finditer(body)]
+    rows: dict[int, bytes] = {
+        n: body[s:e] for (s, n), (e, _) in zip(marks, marks[1:] + [(len(body), 0)])
+    }
+
+    # 1. edited cells (positions are still the original ones)
+    touched: dict[int, list] = {}
+    for pos, col, value in diff["changed"]:
+        touched.setdefault(first + pos, []).append((col, value))
+    for n, cells in touched.items():
+        row = codec.parse(rows.get(n, b'<row r="%d"/>' % n))
+        for col, value in cells:
+            _set_cell_value(_row_cell(row, letters[col]), value)
+        rows[n] = codec.dump(row)
+    rows = dict(sorted(rows.items()))          # edits may have created rows
+
+    # 2. deleted rows: drop, renumber the rows below, keep styles by position
+    if diff["deleted"]:
+        gone = sorted(first + p for p in diff["deleted"])
+        gone_set = set(gone)
+        moved: dict[int, bytes] = {}
+        for n, chunk in rows.items():
+            if n in gone_set:
+                continue
+            m = n - bisect.bisect_left(gone, n)
+            if m != n:
+                ref = rows.get(m)
+                if ref is not None:
+                    chunk = codec.restyle_like(chunk, n, ref, m)
+                chunk = codec.renumber(chunk, m)
+            moved[m] = chunk
+        rows = moved
+
+    # 3. appended rows, styled like the row two above (same stripe)
+    last = max(rows) if rows else header_rows
+    for values in diff["added"]:
+        last += 1
+        proto  = rows.get(last - 2) if last - 2 >= first else None
+        proto  = proto if proto is not None else rows.get(last - 1)
+        styles = codec.styles(proto) if proto is not None else {}
+        row = codec.parse(b'<row r="%d"/>' % last)
+        for col, value in enumerate(values):
+            c = _row_cell(row, letters[col])
+            if styles.get(letters[col]):
+                c.set("s", styles[letters[col]])
+            _set_cell_value(c, value)
+        rows[last] = codec.dump(row)
+
+    if rows:
+        head = _DIM_RE.sub(rb'\g<1>%d"' % max(rows), head, count=1)
+    xml = head + b"".join(rows.values()) + tail
+
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            if info.filename == part:
+                zout.writestr(info, xml, compresslevel=1)
+            else:
+                zout.writestr(info, zin.read(info))
+    return out.getvalue()
+
+
 def _renumber_serials(results: list[dict],
                       json_field: str = "Serial_Number",
                       excel_header: str = "Item No.") -> None:
@@ -502,14 +3625,20 @@ def _renumber_serials(results: list[dict],
     serial number (1, 2, 3 …) across all Fracto chunks.
 
     The column name in the JSON is *json_field*; if it differs between your two
-    formats, you can look it up via mappings in the caller instead.
+    formats, you can look it up via mappings in the caller instead. Only the
+    saved JSON needs this – tables renumber their own columns (`FormatSpec.table`).
     """
     counter = 1
     for res in results:
-        rows = _extract_rows(res.get("data", []))
-        for row in rows:
-            row[json_field] = counter
-            counter += 1
+        counter = _renumber_from(res, counter, json_field)
+
+
+def _renumber_from(result: dict, start: int, json_field: str = "Serial_Number") -> int:
+    """Number one chunk's rows start, start+1, …; returns the next free serial."""
+    for row in _extract_rows(result.get("data", [])):
+        row[json_field] = start
+        start += 1
+    return start
 
 
 # ─── Main Entry Point ────────────────────────────────────────────────────
@@ -0,0 +1,15 @@
+"""`OcrCache` size accounting, which drives eviction."""
+import mcc
+
+
+def _on_disk(root) -> int:
+    return sum(p.stat().st_size for p in root.glob("*/*.json"))
+
+
+def test_rewriting_a_key_does_not_inflate_the_size(tmp_path):
+    cache = mcc.OcrCache(tmp_path, max_bytes=10**6)
+    cache.put("ab" * 32, {"rows": []})           # first put measures the directory
+    for n in range(20):
+        cache.put("ab" * 32, {"rows": ["x" * n]})
+    cache.put("cd" * 32, {"rows": []})
+    assert cache._size == _on_disk(tmp_path)
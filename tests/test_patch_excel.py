@@ -0,0 +1,110 @@
+"""
+Round-trips for `mcc.patch_excel`: write a workbook, edit the grid the way
+the app does (`diff_frames` of the DataFrame before/after), patch, and
+reload the result with openpyxl.
+"""
+import io
+
+import pytest
+from openpyxl import Workbook, load_workbook
+
+import mcc
+
+MAPPINGS = {"Item No.": "Serial_Number", "Part No.": "part_no", "Qty": "Qty"}
+ROWS = [
+    {"Serial_Number": 1, "part_no": "A-1", "Qty": 5},
+    {"Serial_Number": 2, "part_no": "B-2", "Qty": 7},
+    {"Serial_Number": 3, "part_no": "C-3", "Qty": 9},
+    {"Serial_Number": 4, "part_no": "D-4", "Qty": 11},
+]
+
+
+def _workbook(**kwargs) -> tuple[bytes, "mcc.OcrTable"]:
+    table = mcc.FormatSpec("test", {"mappings": MAPPINGS}).table([{"status": "ok", "data": ROWS}])
+    buf = io.BytesIO()
+    mcc.write_excel_from_ocr(table, buf, **kwargs)
+    return buf.getvalue(), table
+
+
+def _patch(xlsx: bytes, before, after, sheet_name=None):
+    patched = mcc.patch_excel(xlsx, mcc.diff_frames(before, after), sheet_name=sheet_name)
+    wb = load_workbook(io.BytesIO(patched))
+    return wb, (wb[sheet_name] if sheet_name else wb.active)
+
+
+def _values(ws) -> list[tuple]:
+    return [tuple(r) for r in ws.iter_rows(min_row=2, values_only=True)]
+
+
+def _fill(ws, row: int) -> str:
+    return ws.cell(row=row, column=1).fill.fgColor.rgb
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_edit_cell_keeps_value_type_and_style(streaming):
+    xlsx, table = _workbook(streaming=streaming)
+    before = table.to_dataframe()
+    after = before.copy()
+    after.loc[1, "Part No."] = "B-2X"
+    after.loc[2, "Qty"] = 42
+
+    original = load_workbook(io.BytesIO(xlsx)).active
+    wb, ws = _patch(xlsx, before, after)
+
+    assert _values(ws) == [(1, "A-1", 5), (2, "B-2X", 7), (3, "C-3", 42), (4, "D-4", 11)]
+    assert [_fill(ws, r) for r in range(2, 6)] == [_fill(original, r) for r in range(2, 6)]
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_delete_middle_row_shifts_rows_and_keeps_stripes(streaming):
+    xlsx, table = _workbook(streaming=streaming)
+    before = table.to_dataframe()
+    after = before.drop(index=1)
+
+    original = load_workbook(io.BytesIO(xlsx)).active
+    wb, ws = _patch(xlsx, before, after)
+
+    assert _values(ws) == [(1, "A-1", 5), (3, "C-3", 9), (4, "D-4", 11)]
+    assert ws.max_row == 4
+    assert ws.calculate_dimension() == "A1:C4"
+    # formatting stays with the row position, so zebra striping is unbroken
+    assert [_fill(ws, r) for r in range(2, 5)] == [_fill(original, r) for r in range(2, 5)]
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_append_row_copies_stripe_from_two_rows_above(streaming):
+    xlsx, table = _workbook(streaming=streaming)
+    before = table.to_dataframe()
+    after = before.copy()
+    after.loc[len(after)] = [5, "E-5", 13]
+
+    original = load_workbook(io.BytesIO(xlsx)).active
+    wb, ws = _patch(xlsx, before, after)
+
+    assert _values(ws)[-1] == (5, "E-5", 13)
+    assert ws.max_row == 6
+    assert _fill(ws, 6) == _fill(original, 4)
+    assert ws.cell(row=6, column=1).border.left.style == original.cell(row=4, column=1).border.left.style
+
+
+def test_patch_template_sheet_that_is_not_active(tmp_path):
+    template = tmp_path / "template.xlsx"
+    wb = Workbook()
+    wb.active.title = "Cover"
+    wb.active["A1"] = "Cover page"
+    wb.create_sheet("Data")
+    wb.active = 0                     # "Cover" stays the active sheet
+    wb.save(template)
+    mcc.template_cache.clear()
+
+    xlsx, table = _workbook(template_path=str(template), sheet_name="Data")
+    before = table.to_dataframe()
+    after = before.drop(index=0)
+    after.loc[2, "Qty"] = 99
+
+    wb, ws = _patch(xlsx, before, after, sheet_name="Data")
+
+    assert wb.active.title == "Cover"
+    assert wb["Cover"]["A1"].value == "Cover page"
+    assert wb["Cover"].max_row == 1
+    assert _values(ws) == [(2, "B-2", 7), (3, "C-3", 99), (4, "D-4", 11)]
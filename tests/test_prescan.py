@@ -0,0 +1,81 @@
+"""
+`PdfDocument.scan_page` / `_is_blank` on small reportlab pages: the
+pre-scan must never classify a page that paints something as blank.
+"""
+import io
+
+import pytest
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+import mcc
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def _striped_image():
+    img = Image.new("L", (120, 60), 255)
+    for x in range(0, 120, 3):
+        for y in range(60):
+            img.putpixel((x, y), 0)
+    return img
+
+
+def _pdf(*draws) -> bytes:
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+    for draw in draws:
+        draw(c)
+        c.showPage()
+    c.save()
+    return buf.getvalue()
+
+
+def _scan(pdf: bytes, page: int = 0):
+    return mcc.PdfDocument(pdf).scan_page(page)
+
+
+def test_empty_page_is_blank():
+    scan = _scan(_pdf(lambda c: None))
+    assert (scan.glyphs, scan.images) == (0, 0)
+    assert mcc._is_blank(scan)
+
+
+def test_xobject_image_page_is_not_blank():
+    scan = _scan(_pdf(lambda c: c.drawImage(ImageReader(_striped_image()), 50, 50, 400, 200)))
+    assert scan.images == 1
+    assert not mcc._is_blank(scan)
+
+
+def test_inline_image_page_is_not_blank():
+    # fax-to-PDF tools and scanners often store the whole page inline (BI … ID … EI)
+    scan = _scan(_pdf(lambda c: c.drawInlineImage(_striped_image(), 50, 50, 400, 200)))
+    assert scan.images == 1
+    assert scan.paths == 0                # the image data is not read as path operators
+    assert not mcc._is_blank(scan)
+
+
+def _text(*lines):
+    def draw(c):
+        for k, line in enumerate(lines):
+            c.drawString(72, 760 - 14 * k, line)
+    return draw
+
+
+def test_blank_page_inside_an_invoice_does_not_split_it():
+    body = "Widget, stainless, 40 mm  x 12  @ 3.50"
+    pdf = _pdf(_text("Invoice No: A-100", body),     # 0
+               lambda c: None,                        # 1  blank back of page 0
+               _text("Continued", body, body),        # 2
+               lambda c: None,                        # 3  separator
+               _text("Invoice No: B-200", body),      # 4
+               _text("Continued", body, body))        # 5
+    ranges, skips, _ = mcc.plan_chunks(mcc.PdfDocument(pdf), prescan=True,
+                                       chunk_size=2, min_tail=1)
+
+    assert [list(r) for r in ranges] == [[0, 2], [3], [4, 5]]
+    assert skips == {1: {"blank": 1}}
+
+    tagged = mcc._tag_chunk({"status": "ok"}, 0, ranges[0], None, None)
+    assert (tagged["pages"], tagged["skipped_pages"]) == ([1, 3], [2])